@@ -13,34 +13,37 @@ f=poap_nexus_script.py ; cat $f | sed '/^#md5sum/d' > $f.md5 ; sed -i \
 "s/^#md5sum=.*/#md5sum=\"$(md5sum $f.md5 | sed 's/ .*//')\"/" $f
 """
 
-import glob
+import time
+import_start = time.time()
+
+# Modules only some features need (yaml, tarfile, glob, shutil, gzip, subprocess)
+# are imported where they are used, to keep the start of the script short
+import hashlib
 import os
-import pkgutil
+import queue
 import re
-import shutil
 import signal
 import sys
 import syslog
-import time
+import threading
 from time import gmtime, strftime
-import tarfile
 import errno
-import yaml
-
-
-try:
-    import subprocess as sp
-except ImportError:
-    sp = None
+import json
 
 try:
     from cisco import cli
     from cisco import transfer
     legacy = True
 except ImportError:
-    from cli import *
+    try:
+        from cli import *
+    except ImportError:
+        # Not running on a switch, e.g. imported by poap_server_tool.py
+        cli = None
     legacy = False
 
+import_time = time.time() - import_start
+
 
 #Global options that are used throughout the script
 options = {
@@ -73,6 +76,7 @@ options = {
     "upgrade_image_path": "/files/nxos/",
     
     # (Required) Set the required free space on the bootflash in MB (10,000 MB = 10 GB)
+    # This is only used for files whose size can't be found in the manifest or from the file server
     "required_space": 10000,
     
     # (Required) Set if HTTPS certificates are required
@@ -106,7 +110,31 @@ nxos_version = ""
 nxos_date = ""
 hostname = ""
 DNS = ""
+manifest = None
+device_recipe = None
+config_index = None
+neighbor_table = None
+config_fetched = False
+extracted_images = []
+show_version_output = None
+profiler = None
+task_profilers = []
+memory_snapshots = None
+standby_sync_queue = None
+standby_sync_thread = None
+standby_sync_stats = {"copied": 0, "copied_bytes": 0, "skipped": 0, "skipped_bytes": 0, "removed": 0, "failed": 0}
+log_lock = threading.Lock()
+cache_lock = threading.Lock()
+manifest_lock = threading.RLock()
+log_rotation_thread = None
+
 
+class POAPError(Exception):
+    """
+    Raised by abort() when it is called from a worker thread. Only the main thread
+    can roll back and exit, so the error is handed back to it instead.
+    """
+    pass
 
 
 def set_defaults_and_validate_options():
@@ -157,6 +185,8 @@ def set_defaults_and_validate_options():
     set_default("mode", options["mode"])
     # The next upgrade to target on the path
     set_default("upgrade_system_image", "")
+    # Set to True when the configuration is copied in this run (final upgrade)
+    set_default("copy_config", False)
     # List of the Cisco approved upgrade path
     set_default("upgrade_path", options["upgrade_path"])
     # Required space to copy config kickstart and system image in KB
@@ -171,6 +201,8 @@ def set_defaults_and_validate_options():
     set_default("destination_path", "/bootflash/")
     set_default("serial_number","")
     set_default("install_path", "")
+    # Fleet recipe index on the server, used instead of <install_path>/<serial>/<serial>.yaml
+    set_default("recipe_index", "")
     set_default("use_nxos_boot", False)
     set_default("https_require_certificate", options["https_require_certificate"])
     
@@ -186,6 +218,20 @@ def set_defaults_and_validate_options():
     set_default("usb_slot", 1)
     # Source file name of Config file
     set_default("source_config_file", "poap.cfg")
+    # How the config file is applied: "replace" (erase, then scheduled-config) or "diff"
+    # (only the changed lines, live, if they are few and safe enough)
+    set_default("config_apply_mode", "replace")
+    set_default("diff_max_changes", 50)
+    set_default("diff_unsafe_sections", ["boot", "feature", "hardware", "system", "vdc", "install",
+                                         "interface mgmt0", "vrf context management"])
+    # Grammar to validate the config file with before it is applied (empty to skip)
+    set_default("config_grammar", "")
+    # MD5 of the config file when it is known from the config index
+    set_default("source_config_md5", "")
+    # Config lookup index on the server (empty to use the file name of the mode)
+    set_default("config_index", "")
+    # Which switch identifiers are looked up in the config index, first match wins
+    set_default("config_lookup_order", ["serial_number", "mac", "hostname", "location"])
 
     set_default("vrf", os.environ['POAP_VRF'])
     set_default("destination_config", "poap_conf.cfg")
@@ -204,6 +250,56 @@ def set_defaults_and_validate_options():
     set_default("compact_image", False)
     set_default("only_allow_versions_in_upgrade_path", options["only_allow_versions_in_upgrade_path"])
 
+    # Bootflash space planning
+    # Manifest on the file server listing the size and MD5 of the files (empty to disable)
+    set_default("manifest_file", "")
+    # Extra free space in MB kept on top of the planned downloads
+    set_default("space_margin", 100)
+    # Delete stale images, .tmp files and old logs when the bootflash is too full
+    set_default("evict_stale_files", True)
+
+    # Download HTTP and HTTPS files in Python instead of with the copy CLI
+    set_default("native_transfer", False)
+    # Write buffer size in MB for native transfers
+    set_default("native_transfer_buffer", 4)
+
+    # Number of recipe artifacts (licenses, RPMs, certificates) downloaded at the same time
+    set_default("recipe_download_workers", 4)
+    # Slowest expected transfer rate in MB/s, used to compute per-file copy timeouts
+    set_default("min_transfer_rate", 1)
+
+    # Check the impact of "install all" before the configuration is erased
+    set_default("install_impact_check", True)
+    set_default("abort_on_disruptive_install", False)
+
+    # Profile the run: "cpu", "memory" or "all" (the POAP_PROFILE environment variable overrides it)
+    set_default("profile", "")
+
+    # Time in seconds the script may take from its start until it begins its work
+    set_default("startup_time_budget", 1)
+
+    # Run the steps of main() one after the other instead of as a graph of tasks
+    set_default("serial_execution", False)
+    # Number of tasks of main() that can run at the same time
+    set_default("task_workers", 4)
+
+    # Polling of "show install all status" while the install runs, in seconds
+    set_default("install_poll_interval", 5)
+    set_default("install_poll_max_interval", 60)
+
+    # RPM tag number of NXOSRPMTYPE (found automatically if not set)
+    set_default("rpm_nxos_type_tag", None)
+
+    # Log history
+    # Number of old POAP script logs (one per run) kept compressed on the bootflash
+    set_default("log_history_count", 5)
+    # Maximum total size of the compressed log history in MB
+    set_default("log_history_max_size", 50)
+    # Upload the current log and the log history to the file server at the end of the run
+    set_default("upload_logs", False)
+    # Directory on the file server the log bundle is uploaded to
+    set_default("log_upload_path", "/files/poap/logs/")
+
     # Check that options are valid
     validate_options()
 
@@ -242,6 +338,16 @@ def set_default(key, value):
     # mistype any options
     valid_options.add(key)
 
+def import_subprocess():
+    """
+    Imports the subprocess module when it is first needed. Returns None if it isn't available.
+    """
+    try:
+        import subprocess
+        return subprocess
+    except ImportError:
+        return None
+
 def byte2str(byte_str):
     '''Ensuring python2 to python3 compatibility for subprocess outputs'''
     try:
@@ -250,67 +356,92 @@ def byte2str(byte_str):
         pass
     return byte_str
 
+ROLLBACK_JOURNAL = "/bootflash/poap_files/rollback_journal"
+
+
+def write_rollback_journal(entry):
+    """
+    Appends an entry to the rollback journal. It is on the bootflash before the action
+    it describes is done, so an abort at any point can undo everything that was done.
+    """
+    with open(ROLLBACK_JOURNAL, "a") as journal_hdl:
+        journal_hdl.write(json.dumps(entry) + "\n")
+        journal_hdl.flush()
+        os.fsync(journal_hdl.fileno())
+
+
+def read_rollback_journal():
+    """
+    Reads the entries of the rollback journal. A last entry cut short (the script was
+    killed while writing it) is ignored, its action wasn't done.
+    """
+    entries = []
+    try:
+        with open(ROLLBACK_JOURNAL, "r") as journal_hdl:
+            for line in journal_hdl:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break
+    except (IOError, OSError):
+        pass
+    return entries
+
+
+def rewrite_lines(filename, rewrite):
+    """
+    Rewrites a text file line by line through a function (returning None drops the line)
+    """
+    if not os.path.isfile(filename):
+        return
+    with open(filename, "r") as src, open("%s.tmp" % filename, "w") as dst:
+        for line in src:
+            line = rewrite(line)
+            if line != None:
+                dst.write(line)
+    os.rename("%s.tmp" % filename, filename)
+
+
 def rollback_rpm_license_certificates():
     '''Rolling back installed rpms,licenses and certificates during abort'''
-    try:
-        fpx = open("/bootflash/poap_files/success_install_list")
-    except:
+    entries = read_rollback_journal()
+    if len(entries) == 0:
         return
-    version = get_nxos_version()
-    image_parts = [part for part in re.split("[\.()]", version) if part]
-    rollback_files = fpx.readlines()
-    for file in rollback_files:
-        file = file.strip('\n')
-        if file.endswith(".rpm"):
-            group_string = "/usr/bin/rpm -qp --qf %{GROUP} /bootflash/poap_files/" + file
-            rpm_string = "/usr/bin/rpm -qp --queryformat %{NXOSRPMTYPE} /bootflash/poap_files/" + file
-            rpmgrp = subprocess.check_output(group_string, shell=True)
-            rpmtype = subprocess.check_output(rpm_string, shell=True)
-            rpmgrp = byte2str(rpmgrp)
-            rpmtype = byte2str(rpmtype)
-            if (len(rpmgrp) != 0 and 'Patch-RPM' in rpmgrp):
-                poap_log("Rolling back patch RPM %s" %(file))
-                os.system("rm -rf /bootflash/.rpmstore/patching/patchrepo/%s" %file)
-                os.system("rm -rf /bootflash_sup-remote/.rpmstore/patching/patchrepo/%s" %file)
-                removal_entry = file.replace(".rpm", "")
-                entry_removal_string = "sed -i 's/ {0}//g' /bootflash/.rpmstore/patching/patchrepo/meta/patching_meta.inf".format(removal_entry)
-                standby_removal_string = "sed -i 's/ {0}//g' /bootflash_sup-remote/.rpmstore/patching/patchrepo/meta/patching_meta.inf".format(removal_entry)
-                os.system(entry_removal_string)               
-                os.system(standby_removal_string)
-                if(int(image_parts[0]) >= 10):
-                    os.system("sudo /usr/bin/createrepo_c --update /bootflash/.rpmstore/patching/patchrepo/")
-                    os.system("sudo /usr/bin/createrepo_c --update /bootflash_sup-remote/.rpmstore/patching/patchrepo/")
-                else:                
-                    os.system("sudo /usr/bin/python /usr/share/createrepo/genpkgmetadata.py --update /bootflash/.rpmstore/patching/patchrepo/")
-                    os.system("sudo /usr/bin/python /usr/share/createrepo/genpkgmetadata.py --update /bootflash_sup-remote/.rpmstore/patching/patchrepo/")
-            else:
-                if (len(rpmtype) != 0 and 'feature' in rpmtype):
-                    poap_log("Rolling back NXOS RPM %s" %(file))
-                    os.system("rm -rf /bootflash/.rpmstore/patching/localrepo/%s" %file)
-                    os.system("rm -rf /bootflash_sup-remote/.rpmstore/patching/localrepo/%s" %file)
-                    if(int(image_parts[0]) >= 10):
-                        os.system("sudo /usr/bin/createrepo_c --update /bootflash/.rpmstore/patching/localrepo/")
-                        os.system("sudo /usr/bin/createrepo_c --update /bootflash_sup-remote/.rpmstore/patching/localrepo/")
-                    else:                       
-                        os.system("sudo /usr/bin/python /usr/share/createrepo/genpkgmetadata.py --update /bootflash/.rpmstore/patching/localrepo/")          
-                        os.system("sudo /usr/bin/python /usr/share/createrepo/genpkgmetadata.py --update /bootflash_sup-remote/.rpmstore/patching/localrepo/")
-                else:
-                    poap_log("Rolling back thirdparty RPM %s" %(file))
-                    os.system("rm -rf /bootflash/.rpmstore/thirdparty/%s" %file)      
-                    os.system("rm -rf /bootflash_sup-remote/.rpmstore/thirdparty/%s" %file)            
-                    if(int(image_parts[0]) >= 10):
-                        os.system("sudo /usr/bin/createrepo_c --update /bootflash/.rpmstore/thirdparty/")
-                        os.system("sudo /usr/bin/createrepo_c --update /bootflash_sup-remote/.rpmstore/thirdparty/")
-                    else:                     
-                        os.system("sudo /usr/bin/python /usr/share/createrepo/genpkgmetadata.py --update /bootflash/.rpmstore/thirdparty/")
-                        os.system("sudo /usr/bin/python /usr/share/createrepo/genpkgmetadata.py --update /bootflash_sup-remote/.rpmstore/thirdparty/")
-            poap_log("Removal of RPM names from nxos_rpms_persisted list")
-            rpm_name = subprocess.check_output("/usr/bin/rpm -qp --qf %%{NAME} /bootflash/poap_files/%s" %file, shell=True)
-            rpm_name = byte2str(rpm_name)
-            rpm_persisted_removal_string = "sed -i '/^{0}$/d' /bootflash/.rpmstore/nxos_rpms_persisted" .format(rpm_name)
-            standby_persisted_removal_string = "sed -i '/^{0}$/d' /bootflash_sup-remote/.rpmstore/nxos_rpms_persisted" .format(rpm_name)
-            os.system(rpm_persisted_removal_string)
-            os.system(standby_persisted_removal_string)
+
+    # Replay the journal in reverse, gathering the work so each file is edited once
+    patch_entries = []
+    persisted_names = set()
+    rpm_files = []
+    for entry in reversed(entries):
+        if entry["action"] == "patch_meta":
+            patch_entries.extend(entry["entries"])
+        elif entry["action"] == "persist":
+            persisted_names.add(entry["name"])
+        elif entry["action"] == "copy_rpm":
+            rpm_files.append((entry["repo"], entry["file"]))
+
+    for path in ["/bootflash/.rpmstore/patching/patchrepo/meta/patching_meta.inf",
+                 "/bootflash_sup-remote/.rpmstore/patching/patchrepo/meta/patching_meta.inf"]:
+        if len(patch_entries) == 0:
+            break
+        poap_log("Rolling back patch RPM(s) %s in %s" % (", ".join(patch_entries), path))
+        rewrite_lines(path, lambda line: re.sub("|".join(" %s" % re.escape(name) for name in patch_entries), "", line))
+
+    for path in ["/bootflash/.rpmstore/nxos_rpms_persisted", "/bootflash_sup-remote/.rpmstore/nxos_rpms_persisted"]:
+        if len(persisted_names) == 0:
+            break
+        poap_log("Removal of RPM names from nxos_rpms_persisted list: %s" % ", ".join(sorted(persisted_names)))
+        rewrite_lines(path, lambda line: None if line.rstrip("\n") in persisted_names else line)
+
+    touched_repos = set()
+    for repo, file in rpm_files:
+        poap_log("Rolling back RPM %s from %s" % (file, repo))
+        remove_file(os.path.join(repo, file))
+        queue_standby_sync(None, get_standby_path(os.path.join(repo, file)), "remove")
+        touched_repos.add(repo)
+    wait_for_standby_sync()
+    refresh_rpm_repos(touched_repos)
+
     os.system("rm -rf /bootflash/poap_files")
     standby = cli("show module | grep ha-standby")
     if(len(standby) > 0):
@@ -324,18 +455,125 @@ def abort(error_message=None):
 
     if error_message != None:
         poap_log(error_message)
+
+    if threading.current_thread() is not threading.main_thread():
+        raise POAPError(error_message or "Aborted")
     
     rollback_rpm_license_certificates()
     cleanup_files()
+    upload_log_bundle()
     close_log_handle()
     exit(1)
 
 
+def start_profiling():
+    """
+    Starts cProfile (and tracemalloc) around main() if the "profile" option or the
+    POAP_PROFILE environment variable is set to "cpu", "memory" or "all". Nothing is
+    imported or hooked otherwise.
+    """
+    global profiler, memory_snapshots
+
+    mode = os.environ.get("POAP_PROFILE") or options.get("profile") or ""
+    if mode not in ["cpu", "memory", "all"]:
+        return
+
+    if mode in ["memory", "all"]:
+        import tracemalloc
+        tracemalloc.start()
+        memory_snapshots = []
+    if mode in ["cpu", "all"]:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+
+def profile_checkpoint(phase):
+    """
+    Takes a tracemalloc snapshot at the end of a phase of main() when memory profiling
+    is on, see start_profiling()
+    """
+    if memory_snapshots == None:
+        return
+
+    import tracemalloc
+    current, peak = tracemalloc.get_traced_memory()
+    memory_snapshots.append((phase, current, peak, tracemalloc.take_snapshot()))
+
+
+def profile_task(function):
+    """
+    Runs a task of run_tasks() under its own profiler when CPU profiling is on, since
+    cProfile only sees the thread it is enabled in
+    """
+    if profiler == None or threading.current_thread() is threading.main_thread():
+        return function()
+
+    import cProfile
+    task_profiler = cProfile.Profile()
+    task_profilers.append(task_profiler)
+    return task_profiler.runcall(function)
+
+
+def stop_profiling():
+    """
+    Stops profiling and writes the results next to the script log:
+    *_profile.txt (hottest functions), *_profile.pstats (for pstats/snakeviz)
+    and *_memory.txt (top allocations at each phase)
+    """
+    global profiler, memory_snapshots
+
+    if profiler == None and memory_snapshots == None:
+        return
+
+    # Stop measuring before the results are processed
+    if profiler != None:
+        profiler.disable()
+    profile_checkpoint("end")
+
+    if globals().get("log_hdl") != None:
+        prefix = log_hdl.name.replace("script.log", "")
+    else:
+        prefix = "/bootflash/%s_poap_%s_" % (strftime("%Y%m%d%H%M%S", gmtime()), os.environ.get('POAP_PID', ""))
+
+    try:
+        if profiler != None:
+            import io
+            import pstats
+            stats = pstats.Stats(profiler)
+            for task_profiler in task_profilers:
+                stats.add(task_profiler)
+            stats.dump_stats("%sprofile.pstats" % prefix)
+            summary = io.StringIO()
+            stats.stream = summary
+            stats.sort_stats("cumulative").print_stats(50)
+            with open("%sprofile.txt" % prefix, "w") as profile_hdl:
+                profile_hdl.write(summary.getvalue())
+            poap_log("CPU profile written to %sprofile.txt and %sprofile.pstats" % (prefix, prefix))
+
+        if memory_snapshots != None:
+            import tracemalloc
+            with open("%smemory.txt" % prefix, "w") as memory_hdl:
+                for phase, current, peak, snapshot in memory_snapshots:
+                    memory_hdl.write("%s: %d bytes allocated, %d bytes peak\n" % (phase, current, peak))
+                    for stat in snapshot.statistics("lineno")[:10]:
+                        memory_hdl.write("    %s\n" % str(stat))
+            tracemalloc.stop()
+            poap_log("Memory profile written to %smemory.txt" % prefix)
+    except (IOError, OSError) as e:
+        poap_log("WARN: Failed to write the profile: %s" % str(e))
+
+    profiler = None
+    memory_snapshots = None
+
+
 def close_log_handle():
     """
     Closes the log handle if it exists
     """
+    stop_profiling()
     if "log_hdl" in globals() and log_hdl != None:
+        wait_for_log_rotation()
         log_hdl.close()
 
 
@@ -388,24 +626,124 @@ def set_syslog_prefix():
                 return
 
 
-def poap_cleanup_script_logs():
+def poap_rotate_script_logs(current_log):
     """
-    Deletes all the POAP log files on the bootflash
+    Keeps the logs of the last "log_history_count" POAP runs on the bootflash instead
+    of deleting them, so a failure on a later hop can still be traced back through the
+    earlier hops. Logs beyond the history count are deleted right away, the remaining
+    ones are compressed in the background while the current run continues.
     """
-    file_list = sorted(glob.glob(os.path.join("/bootflash", '*poap*script.log')), reverse=True)
+    global log_rotation_thread
+
+    # Same as the *poap*script.log(.gz) glob, without importing glob on every run
+    file_list = sorted([os.path.join("/bootflash", name) for name in os.listdir("/bootflash")
+                        if re.match(".*poap.*script\\.log(\\.gz)?$", name)], reverse=True)
+    file_list = [log for log in file_list if log != current_log]
+
     if len(file_list) == 0:
         poap_log("No old POAP script logs were found")
         return
-    elif len(file_list) == 1:
-        poap_log("Found %d old POAP script log" % len(file_list))
-        poap_log("The old POAP log will be deleted now")
-    else:
-        poap_log("Found %d old POAP script logs" % len(file_list))
-        poap_log("Old POAP logs will be deleted now")
-    
-    for log in file_list:
+
+    # The log filenames start with a timestamp, so newest logs sort first
+    history_count = options["log_history_count"]
+    poap_log("Found %d old POAP script log(s), keeping the last %d" % (len(file_list), history_count))
+
+    for log in file_list[history_count:]:
         remove_file(log)
 
+    log_rotation_thread = threading.Thread(target=compress_script_logs,
+                                           args=(file_list[:history_count],))
+    log_rotation_thread.daemon = True
+    log_rotation_thread.start()
+
+
+def compress_script_logs(file_list):
+    """
+    Compresses the old POAP script logs with gzip and removes the oldest ones until the
+    total size of the log history fits into "log_history_max_size" (in MB).
+    """
+    import gzip
+    import shutil
+
+    history = []
+    for log in file_list:
+        if log.endswith(".gz"):
+            history.append(log)
+            continue
+        try:
+            with open(log, "rb") as src, gzip.open("%s.gz.tmp" % log, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.rename("%s.gz.tmp" % log, "%s.gz" % log)
+            os.remove(log)
+            history.append("%s.gz" % log)
+        except (IOError, OSError) as e:
+            poap_log("WARN: Failed to compress %s: %s" % (log, str(e)))
+            remove_file("%s.gz.tmp" % log)
+
+    max_size = options["log_history_max_size"] * 1024 * 1024
+    total_size = 0
+    for log in history:
+        try:
+            total_size += os.path.getsize(log)
+        except OSError:
+            continue
+        if total_size > max_size:
+            remove_file(log)
+
+    poap_log("Old POAP script logs compressed (%d kept)" % len([log for log in history if os.path.exists(log)]))
+
+
+def wait_for_log_rotation(timeout=30):
+    """
+    Waits for the background compression of the old logs to finish
+    """
+    if log_rotation_thread != None and log_rotation_thread.is_alive():
+        log_rotation_thread.join(timeout)
+
+
+def upload_log_bundle():
+    """
+    Bundles the current log together with the compressed log history and uploads it to
+    the file server in a single transfer. Only used if "upload_logs" is set to True.
+    A failed upload is logged but never aborts the script.
+    """
+    if not options.get("upload_logs") or globals().get("log_hdl") == None or os.environ.get("POAP_PHASE", None) == "USB":
+        return
+
+    wait_for_log_rotation()
+
+    protocol = options["transfer_protocol"]
+    if legacy or protocol in ["http", "https"]:
+        poap_log("WARN: Log upload is not supported with %s, skipping log upload" %
+                 ("the transfer module" if legacy else protocol))
+        return
+
+    import glob
+    import tarfile
+
+    bundle_name = "%s_%s_poap_logs.tar.gz" % (options.get("serial_number") or os.environ.get("POAP_SERIAL", "unknown"),
+                                              strftime("%Y%m%d%H%M%S", gmtime()))
+    bundle = os.path.join("/bootflash", bundle_name)
+    log_list = sorted(glob.glob(os.path.join("/bootflash", "*poap*script.log.gz")))
+    log_list.append(log_hdl.name)
+
+    try:
+        log_hdl.flush()
+        with tarfile.open(bundle, "w:gz") as tar:
+            for log in log_list:
+                tar.add(log, arcname=os.path.basename(log))
+
+        dest = os.path.join(options["log_upload_path"], bundle_name)
+        poap_log("Uploading log bundle %s to %s" % (bundle, dest))
+        cli("terminal dont-ask ; terminal password %s ; copy bootflash:%s %s://%s@%s%s vrf %s" % (
+            options["password"], bundle_name, protocol, options["username"],
+            options["hostname"], dest, options["vrf"]))
+        poap_log("Log bundle uploaded")
+    except Exception as e:
+        poap_log("WARN: Failed to upload log bundle: %s" % str(e))
+
+    remove_file(bundle)
+
 
 def poap_log(info):
     """
@@ -435,10 +773,11 @@ def poap_log(info):
         info = " - %s" % info
 
     syslog.syslog(9, info)
-    if "log_hdl" in globals() and log_hdl != None:
-        log_hdl.write("\n")
-        log_hdl.write(info)
-        log_hdl.flush()
+    with log_lock:
+        if "log_hdl" in globals() and log_hdl != None and not log_hdl.closed:
+            log_hdl.write("\n")
+            log_hdl.write(info)
+            log_hdl.flush()
 
 
 def remove_file(filename):
@@ -453,6 +792,75 @@ def remove_file(filename):
             poap_log("Failed to remove %s: %s" % (filename, str(e)))
 
 
+def read_poap_cache(name):
+    """
+    Reads a JSON cache that POAP keeps on the bootflash across runs (and hops).
+    Returns an empty dictionary if the cache doesn't exist or can't be read.
+    """
+    try:
+        with open(os.path.join("/bootflash/.poap_cache", "%s.json" % name), "r") as cache_hdl:
+            return json.load(cache_hdl)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def write_poap_cache(name, data):
+    """
+    Writes a JSON cache that POAP keeps on the bootflash across runs (and hops)
+    """
+    cache_file = os.path.join("/bootflash/.poap_cache", "%s.json" % name)
+    try:
+        if not os.path.isdir("/bootflash/.poap_cache"):
+            os.makedirs("/bootflash/.poap_cache")
+        with open("%s.tmp" % cache_file, "w") as cache_hdl:
+            json.dump(data, cache_hdl)
+        os.rename("%s.tmp" % cache_file, cache_file)
+    except (IOError, OSError) as e:
+        poap_log("WARN: Failed to write cache %s: %s" % (cache_file, str(e)))
+
+
+def compute_md5(filename):
+    """
+    Computes the MD5 of a file in Python. Unlike md5sum(), this doesn't go through
+    the CLI, so several files can be checked at the same time.
+    """
+    md5 = hashlib.md5()
+    with open(filename, "rb") as file_hdl:
+        for block in iter(lambda: file_hdl.read(1024 * 1024), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def get_verified_md5(filename):
+    """
+    Gets the MD5 of a file from the verification cache, if the file hasn't changed
+    (same size and modification time) since it was verified. Returns None otherwise.
+    """
+    try:
+        stats = os.stat(filename)
+    except OSError:
+        return None
+    with cache_lock:
+        entry = read_poap_cache("verified_files").get(filename)
+    if entry != None and entry["size"] == stats.st_size and entry["mtime"] == stats.st_mtime:
+        return entry["md5"]
+    return None
+
+
+def record_verified_md5(filename, md5):
+    """
+    Stores the MD5 of a verified file in the verification cache
+    """
+    try:
+        stats = os.stat(filename)
+    except OSError:
+        return
+    with cache_lock:
+        cache = read_poap_cache("verified_files")
+        cache[filename] = {"size": stats.st_size, "mtime": stats.st_mtime, "md5": md5}
+        write_poap_cache("verified_files", cache)
+
+
 def cleanup_file_from_option(option, bootflash_root=False):
     """
     Removes a file (indicated by the option in the POAP options) and removes it
@@ -485,6 +893,10 @@ def cleanup_files():
     # Delete downloaded configuration file
     cleanup_file_from_option("destination_config")
 
+    # Delete the system images extracted from the personality tarball
+    for image in extracted_images:
+        remove_file(image)
+
     # Delete created directories
     os.system("rm -rf /bootflash/poap_files")
     os.system("rm -rf /bootflash_sup-remote/poap_files")
@@ -634,7 +1046,9 @@ def split_config_file():
     # If we don't require extra reloads for commands (newer images), skip this
     # splitting of commands (and break the below loop immediately)
     if split_config_is_not_needed == True:
-        config_file_second.write(config_file.read())
+        import shutil
+        # Copy in chunks, the config can be too large to read in one go on small platforms
+        shutil.copyfileobj(config_file, config_file_second, 1024 * 1024)
         line = ""
         poap_log("Skip split config as it isn't needed with %s" % options["target_system_image"])
     else:
@@ -806,7 +1220,8 @@ def verify_md5(md5given, filename):
         poap_log("ERROR: File %s does not exist" % filename)
         return False
 
-    md5calculated = md5sum(filename)
+    # Files copied from USB or verified earlier are in the verification cache
+    md5calculated = get_verified_md5(filename) or md5sum(filename)
 
     try:
         file_size = os.path.getsize(filename)
@@ -819,20 +1234,23 @@ def verify_md5(md5given, filename):
     poap_log("MD5 calculated: " + md5calculated)
     if md5given == md5calculated:
         poap_log("MD5 match for file: {0}".format(filename))
+        record_verified_md5(filename, md5calculated)
         return True
     poap_log("MD5 mis-match for file: {0}".format(filename))
     return False
 
 
-def get_md5(filename, skip_abort = False):
+def get_md5(filename, skip_abort = False, md5_filename = None):
     """
     Fetches the md5 value from .md5 file.
     Args:
         keyword: Keyword to look for in .md5 file
         filename: .md5 filename
+        md5_filename: .md5 file to read, if it isn't named after the file
     """
     # Get the MD5 file
-    md5_filename = "%s.md5" % filename
+    if md5_filename == None:
+        md5_filename = "%s.md5" % filename
 
     if not os.path.exists(os.path.join(options["destination_path"], md5_filename)):
         if (skip_abort == False):
@@ -875,6 +1293,264 @@ def get_bootflash_size():
     poap_log("Unable to get bootflash size")
 
 
+def setns(fd):
+    """
+    Moves the calling thread into the network namespace referred to by fd
+    """
+    if hasattr(os, "setns"):
+        os.setns(fd, os.CLONE_NEWNET)
+        return
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    # CLONE_NEWNET
+    if libc.setns(fd, 0x40000000) != 0:
+        raise OSError(ctypes.get_errno(), "setns failed")
+
+
+class vrf_namespace(object):
+    """
+    Context manager that runs a block of native Python networking code inside the
+    network namespace of the POAP VRF, the same way the copy CLI uses "vrf <name>".
+    If the namespace can't be entered the block runs in the current namespace.
+    """
+    def __enter__(self):
+        self.orig_fd = None
+        netns = "/var/run/netns/%s" % options["vrf"]
+        if not os.path.exists(netns):
+            return self
+        try:
+            self.orig_fd = os.open("/proc/thread-self/ns/net", os.O_RDONLY)
+            target_fd = os.open(netns, os.O_RDONLY)
+            try:
+                setns(target_fd)
+            finally:
+                os.close(target_fd)
+        except (IOError, OSError, AttributeError) as e:
+            poap_log("WARN: Unable to enter the network namespace of vrf %s: %s" % (options["vrf"], str(e)))
+            if self.orig_fd != None:
+                os.close(self.orig_fd)
+                self.orig_fd = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if self.orig_fd != None:
+            setns(self.orig_fd)
+            os.close(self.orig_fd)
+        return False
+
+
+def get_remote_url(path):
+    """
+    Builds the URL of a file on the file server
+    """
+    return "%s://%s%s" % (options["transfer_protocol"], options["hostname"], path)
+
+
+def open_remote_url(path, method="GET", headers=None, timeout=10):
+    """
+    Opens an HTTP or HTTPS request to the file server from Python, without going
+    through the copy CLI. Used for small requests like HEAD and range requests.
+    """
+    import base64
+    import ssl
+    import urllib.request
+
+    request = urllib.request.Request(get_remote_url(path), method=method, headers=headers or {})
+    if options["username"]:
+        credentials = "%s:%s" % (options["username"], options["password"])
+        request.add_header("Authorization", "Basic %s" % byte2str(base64.b64encode(credentials.encode())))
+
+    context = None
+    if options["transfer_protocol"] == "https" and options["https_require_certificate"] == False:
+        context = ssl._create_unverified_context()
+
+    with vrf_namespace():
+        return urllib.request.urlopen(request, timeout=timeout, context=context)
+
+
+def load_manifest():
+    """
+    Downloads the manifest from the file server (once per run) and returns it.
+    The manifest is a JSON file mapping the path of every file on the server
+    to its size and MD5:
+        {"version": 1, "files": {"/files/nxos/nxos.9.3.10.bin": {"size": 1234, "md5": "..."}}}
+    Returns an empty manifest if "manifest_file" isn't set or can't be downloaded.
+    """
+    global manifest
+
+    with manifest_lock:
+        if manifest == None:
+            # The download itself goes through do_copy(), which looks at the manifest
+            manifest = {"version": 1, "files": {}}
+            manifest = download_manifest()
+    return manifest
+
+
+def download_manifest():
+    """
+    Downloads and parses the manifest, see load_manifest()
+    """
+    manifest = {"version": 1, "files": {}}
+    if not options.get("manifest_file") or os.environ.get("POAP_PHASE", None) == "USB":
+        return manifest
+
+    dst = "poap_manifest.json"
+    manifest_path = os.path.join(options["destination_path"], dst)
+    try:
+        do_copy(options["manifest_file"], dst, options["timeout_config"], "%s.tmp" % dst, False, True)
+        with open(manifest_path, "r") as manifest_hdl:
+            manifest = json.load(manifest_hdl)
+        poap_log("Loaded manifest with %d file(s)" % len(manifest.get("files", {})))
+    except Exception as e:
+        poap_log("WARN: Unable to load manifest %s: %s" % (options["manifest_file"], str(e)))
+        manifest = {"version": 1, "files": {}}
+    remove_file(manifest_path)
+    return manifest
+
+
+def get_manifest_entry(path):
+    """
+    Returns the manifest entry (size and md5) of a file on the server, or None
+    """
+    return load_manifest().get("files", {}).get(os.path.normpath(path))
+
+
+def get_remote_file_size(path):
+    """
+    Gets the size in bytes of a file on the file server, from the manifest or
+    with an HTTP HEAD request. Returns None if the size can't be found.
+    """
+    entry = get_manifest_entry(path)
+    if entry != None and "size" in entry:
+        return int(entry["size"])
+
+    if options["transfer_protocol"] in ["http", "https"] and os.environ.get("POAP_PHASE", None) != "USB":
+        try:
+            response = open_remote_url(path, method="HEAD")
+            size = response.headers.get("Content-Length")
+            response.close()
+            if size != None:
+                return int(size)
+        except Exception as e:
+            poap_log("WARN: HEAD request for %s failed: %s" % (path, str(e)))
+
+    return None
+
+
+def preallocate_file(fd, size):
+    """
+    Reserves size bytes on the bootflash for the file descriptor, so running out of
+    space fails right away instead of partway through a multi-GB download
+    """
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            abort("Copy failed: No space left on device (%d bytes needed)" % size)
+        elif e.errno not in [errno.EOPNOTSUPP, errno.EINVAL]:
+            raise
+
+
+def check_space_for_download(dest_tmp, expected_size):
+    """
+    Checks that a download of expected_size bytes fits on the bootflash before the
+    copy CLI or the transfer module starts it, by preallocating the file and
+    releasing it again.
+    """
+    if expected_size == None:
+        return
+
+    fd = os.open(dest_tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        preallocate_file(fd, expected_size)
+    finally:
+        os.close(fd)
+        remove_file(dest_tmp)
+
+
+def native_download(source, dest_tmp, expected_size=None, timeout=10, dont_abort=False, on_data=None):
+    """
+    Downloads a file over HTTP or HTTPS in Python instead of with the copy CLI. The
+    full size of the file is preallocated up front and the data is written with large
+    page-aligned buffers, followed by a single fsync. Returns the number of bytes
+    downloaded after checking it against the expected size (from the manifest or the
+    Content-Length header).
+
+    If on_data is given, it is called with every buffer as it is written, so the data
+    can be processed while it downloads.
+    """
+    import mmap
+    import urllib.error
+
+    try:
+        response = open_remote_url(source, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 404 and dont_abort == True:
+            poap_log("Copy Failed. File/Directory not found")
+            raise
+        elif e.code == 404:
+            abort("Copy of %s failed: no such file" % source)
+        elif e.code in [401, 403]:
+            abort("Copy of %s failed: permission denied" % source)
+        raise
+
+    if expected_size == None and response.headers.get("Content-Length") != None:
+        expected_size = int(response.headers.get("Content-Length"))
+
+    buffer_size = options["native_transfer_buffer"] * 1024 * 1024
+    # Anonymous mmap gives a page-aligned buffer
+    buffer = mmap.mmap(-1, buffer_size)
+    view = memoryview(buffer)
+    downloaded = 0
+    start_time = time.time()
+
+    fd = os.open(dest_tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if expected_size != None:
+            preallocate_file(fd, expected_size)
+
+        eof = False
+        while not eof:
+            # Fill the whole buffer before writing so every write but the last is full size
+            filled = 0
+            while filled < buffer_size:
+                count = response.readinto(view[filled:])
+                if not count:
+                    eof = True
+                    break
+                filled += count
+
+            written = 0
+            while written < filled:
+                written += os.write(fd, view[written:filled])
+            downloaded += filled
+            if on_data != None and filled > 0:
+                on_data(view[:filled])
+
+        # Drop any preallocated space past the end of the data (size mismatch is caught below)
+        os.ftruncate(fd, downloaded)
+        os.fsync(fd)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            abort("Copy failed: No space left on device")
+        raise
+    finally:
+        os.close(fd)
+        response.close()
+        view.release()
+        buffer.close()
+
+    elapsed = max(time.time() - start_time, 0.001)
+    poap_log("Downloaded %d bytes in %.1f seconds (%.1f MB/s)" % (
+             downloaded, elapsed, downloaded / elapsed / (1024 * 1024)))
+
+    if expected_size != None and downloaded != expected_size:
+        remove_file(dest_tmp)
+        abort("Copy of %s is incomplete: %d of %d bytes downloaded" % (source, downloaded, expected_size))
+
+    return downloaded
+
+
 def do_copy(source="", dest="", login_timeout=10, dest_tmp="", compact=False, dont_abort=False):
     """
     Copies the file provided from source to destination. Source could
@@ -890,6 +1566,7 @@ def do_copy(source="", dest="", login_timeout=10, dest_tmp="", compact=False, do
                                                                    dest), login_timeout, dest_tmp))
 
     remove_file(os.path.join(options["destination_path"], dest_tmp))
+    expected_size = None
 
     if os.environ.get("POAP_PHASE", None) == "USB":
         copy_src = os.path.join("/usbslot%s" % (options["usb_slot"]), source)
@@ -898,7 +1575,8 @@ def do_copy(source="", dest="", login_timeout=10, dest_tmp="", compact=False, do
         if os.path.exists(copy_src):
             poap_log("%s exists" % source)
             poap_log("Copying from %s to %s" % (copy_src, dest_tmp))
-            shutil.copy(copy_src, dest_tmp)
+            usb_copy(copy_src, dest_tmp, os.path.join(options["destination_path"], dest))
+            return True
         else:
             abort("/usbslot%d/%s does NOT exist" % (options["usb_slot"], source))
     else:
@@ -911,7 +1589,15 @@ def do_copy(source="", dest="", login_timeout=10, dest_tmp="", compact=False, do
         vrf = options["vrf"]
         poap_log("Transfering using %s from %s to %s hostname %s vrf %s" % (
                  protocol, source, copy_tmp, host, vrf))
-        if legacy:
+
+        manifest_entry = get_manifest_entry(source)
+        if manifest_entry != None and "size" in manifest_entry:
+            expected_size = int(manifest_entry["size"])
+
+        if options["native_transfer"] == True and protocol in ["http", "https"] and compact == False:
+            expected_size = native_download(source, dest_tmp, expected_size, login_timeout, dont_abort)
+        elif legacy:
+            check_space_for_download(dest_tmp, expected_size)
             try:
                 transfer(protocol, host, source, copy_tmp, vrf, login_timeout,
                          user, password)
@@ -929,6 +1615,7 @@ def do_copy(source="", dest="", login_timeout=10, dest_tmp="", compact=False, do
                 else:
                     raise
         else:
+            check_space_for_download(dest_tmp, expected_size)
             # Add the destination path
             copy_cmd = "terminal dont-ask ; terminal password %s ; " % password
             if compact == True:
@@ -985,6 +1672,12 @@ def do_copy(source="", dest="", login_timeout=10, dest_tmp="", compact=False, do
 
     poap_log("*** Downloaded file is of size %s ***" % file_size)
 
+    # The transfer module doesn't report a full bootflash, so compare against the expected size
+    if expected_size != None and file_size != expected_size:
+        remove_file(dest_tmp)
+        abort("Copy of %s is incomplete: %s of %d bytes downloaded (bootflash may be full)" % (
+              source, file_size, expected_size))
+
     dest = os.path.join(options["destination_path"], dest)
 
     try:
@@ -1041,50 +1734,417 @@ def copy_md5_info(file_path, file_name):
         do_copy(src, md5_file_name, timeout, tmp_file)
 
 
-def copy_config():
+def get_config_keyword(line):
     """
-    Copies switch configuration file and verifies if the md5 of the config
-    matches with the value present in .md5 file downloaded.
+    Gets the keyword of a configuration line, the grammar is keyed by it ("no" is skipped)
     """
-    poap_log("Starting application of configuration file")
+    words = line.split()
+    if len(words) > 1 and words[0] == "no":
+        return words[1]
+    return words[0]
 
-    global options
 
-    poap_file = options["destination_config"]
-    config_file = os.path.join(options["destination_path"], poap_file)
-    config_file_with_colon = config_file.replace('/bootflash/', 'bootflash:', 1)
+def parse_config_tree(lines):
+    """
+    Parses NX-OS configuration lines into a tree by their indentation. Each node is
+    (line number, line, children). Blank lines and comments (! and #) are skipped.
+    """
+    root = []
+    stack = [(-1, root)]
+    for line_number, line in enumerate(lines, 1):
+        line = line.rstrip("\r\n")
+        text = line.strip()
+        if text == "" or text.startswith("!") or text.startswith("#"):
+            continue
+        indent = len(line) - len(line.lstrip(" "))
+        while indent <= stack[-1][0]:
+            stack.pop()
+        node = (line_number, text, [])
+        stack[-1][1].append(node)
+        stack.append((indent, node[2]))
+    return root
 
-    if os.path.exists(os.path.join(options["destination_path"], poap_file)):
-        poap_log("Configuration file already exists on bootflash")
-    else:
-        poap_log("Configuration file %s not found" % config_file_with_colon)
-        poap_log("Starting Copy of configuration file to: %s" % config_file)
-        tmp_file = "%s.tmp" % poap_file
-        timeout = options["timeout_config"]
-        src = os.path.join(options["config_path"], options["source_config_file"])
-        do_copy(src, poap_file, timeout, tmp_file)
 
-    if options["require_md5"] == True:
-        copy_md5_info(options["config_path"], options["source_config_file"])
-        md5_sum_given = get_md5(options["source_config_file"])
-        # Remove poap.cfg.md5 after getting the MD5
-        poap_log("Saved MD5 checksum for %s" % os.path.join(options["destination_path"], "%s.md5" % options["source_config_file"]))
-        remove_file(os.path.join(options["destination_path"], "%s.md5" % options["source_config_file"]))
-        if verify_md5(md5_sum_given, config_file):
-            poap_log("Configuration apply can continue")
-        else:
-            abort("MD5 for configuration file %s failed!" % config_file_with_colon)
+def build_config_grammar(lines, grammar=None):
+    """
+    Derives the grammar of the configuration validator from a captured command list:
+    configurations (e.g. "show running-config" of reference switches) or a plain list
+    of commands, indented the same way. The grammar is a tree of keywords, where the
+    children of a keyword are the keywords allowed in the mode it enters:
+        {"hostname": {}, "interface": {"description": {}, "switchport": {}}}
+    """
+    if grammar == None:
+        grammar = {}
 
-    poap_log("The config file path is: " + config_file_with_colon)
-    poap_log("Copying configuration file to startup configuration")
+    def add_nodes(nodes, mode):
+        for _, text, children in nodes:
+            keyword_grammar = mode.setdefault(get_config_keyword(text), {})
+            add_nodes(children, keyword_grammar)
 
-    try:
-        poap_log("Running command: copy %s scheduled-config" % config_file_with_colon)
-        cli("copy %s scheduled-config" % config_file_with_colon)
-        time.sleep(5)
+    add_nodes(parse_config_tree(lines), grammar)
+    return grammar
 
-    except Exception as e:
-        poap_log("Could not copy configuration file to startup configuration!" % config_file_with_colon)
+
+def normalize_interface_name(name):
+    """
+    Normalizes an interface name so abbreviations match (eth1/1 -> ethernet1/1)
+    """
+    name = name.replace(" ", "").lower()
+    for short, full in [("eth", "ethernet"), ("po", "port-channel"), ("lo", "loopback"), ("mgmt", "mgmt")]:
+        if name.startswith(short) and not name.startswith(full) and name[len(short):][:1].isdigit():
+            return full + name[len(short):]
+    return name
+
+
+def validate_config_lines(lines, grammar):
+    """
+    Validates NX-OS configuration lines against a grammar (see build_config_grammar())
+    without a switch. Returns a list of (line number, error) for unknown commands (at
+    the top level or in a mode), lines indented under a command that doesn't enter a
+    mode, and interfaces that are configured more than once.
+    """
+    errors = []
+    interfaces = {}
+
+    def check_nodes(nodes, mode, mode_name):
+        for line_number, text, children in nodes:
+            keyword = get_config_keyword(text)
+            if keyword not in mode:
+                if mode_name == None:
+                    errors.append((line_number, "Unknown top-level command: %s" % text))
+                else:
+                    errors.append((line_number, "Unknown command in %s mode: %s" % (mode_name, text)))
+                continue
+            if mode_name == None and keyword == "interface" and text.split()[0] != "no":
+                interface = normalize_interface_name(text.split(None, 1)[1] if len(text.split()) > 1 else "")
+                if interface in interfaces:
+                    errors.append((line_number, "Duplicate interface %s (first configured on line %d)" % (
+                        text.split(None, 1)[1], interfaces[interface])))
+                else:
+                    interfaces[interface] = line_number
+            if len(children) > 0:
+                if len(mode[keyword]) == 0:
+                    errors.append((children[0][0], "%s doesn't enter a configuration mode: %s" % (
+                        keyword, children[0][1])))
+                    continue
+                check_nodes(children, mode[keyword], keyword)
+
+    check_nodes(parse_config_tree(lines), grammar, None)
+    return sorted(errors)
+
+
+def validate_config_file(path, grammar):
+    """
+    Validates a configuration file, see validate_config_lines()
+    """
+    with open(path, "r") as config_hdl:
+        return validate_config_lines(config_hdl, grammar)
+
+
+def load_config_grammar():
+    """
+    Downloads the grammar of the configuration validator ("config_grammar"), a JSON
+    file written by "poap_server_tool.py config-grammar"
+    """
+    dst = "poap_config_grammar.json"
+    do_copy(options["config_grammar"], dst, options["timeout_config"], "%s.tmp" % dst)
+    grammar_file = os.path.join(options["destination_path"], dst)
+    try:
+        with open(grammar_file, "r") as grammar_hdl:
+            grammar = json.load(grammar_hdl)
+    except (IOError, OSError, ValueError) as e:
+        abort("Unable to load config grammar %s: %s" % (options["config_grammar"], str(e)))
+    remove_file(grammar_file)
+    return grammar
+
+
+def validate_config(config_file):
+    """
+    Validates the configuration file before it is scheduled, so a bad configuration
+    aborts the script instead of costing a reload. Only done if "config_grammar" is set.
+    """
+    if not options["config_grammar"]:
+        return
+
+    start = time.time()
+    errors = validate_config_file(config_file, load_config_grammar())
+    for line_number, error in errors[:20]:
+        poap_log("Config validation: line %d: %s" % (line_number, error))
+    if len(errors) > 0:
+        abort("Configuration file %s has %d error(s)" % (config_file, len(errors)))
+    poap_log("Configuration file %s validated in %.3fs" % (config_file, time.time() - start))
+
+
+def config_tree_to_dict(nodes):
+    """
+    Turns a configuration tree (see parse_config_tree()) into nested dictionaries keyed
+    by the configuration lines, in order
+    """
+    tree = {}
+    for _, text, children in nodes:
+        tree.setdefault(text, {}).update(config_tree_to_dict(children))
+    return tree
+
+
+# Lines that open a configuration mode, even when the mode has no lines under it
+# (e.g. "interface Ethernet1/2" or "line vty" in "show running-config")
+CONFIG_SECTION_PATTERN = re.compile("^(no )?(interface|line|vlan|vrf context|router|address-family|neighbor|"
+                                    "template|role name|class-map|policy-map|class|ip access-list|"
+                                    "ipv6 access-list|mac access-list|object-group|route-map|key chain|key|"
+                                    "monitor session|vpc domain|port-profile|evpn|vni|vdc|control-plane|"
+                                    "spanning-tree mst configuration)\\b")
+
+
+def is_config_section(text, children):
+    """
+    Checks if a configuration line opens a section (has lines under it or is a mode)
+    """
+    return len(children) > 0 or CONFIG_SECTION_PATTERN.match(text) != None
+
+
+# Top-level lines of "show running-config" that are there by default and that
+# configuration files don't list. The diff keeps them.
+RUNNING_CONFIG_DEFAULTS = re.compile("^(copp profile |vdc |rmon event |username admin |snmp-server user admin |"
+                                     "vlan 1$|interface Vlan1$|line console$|line vty$|boot |icam monitor scale$)")
+
+
+def get_vlan_ids(vlans):
+    """
+    Expands a VLAN list like "1,10,20-22" into its VLAN IDs
+    """
+    vlan_ids = set()
+    for vlan_range in vlans.split(","):
+        first, _, last = vlan_range.partition("-")
+        vlan_ids.update(range(int(first), int(last or first) + 1))
+    return vlan_ids
+
+
+def is_running_config_default(text, children, target):
+    """
+    Checks if a top-level line that is only in the running configuration is one of its
+    defaults (see RUNNING_CONFIG_DEFAULTS): an interface without lines under it, or the
+    VLAN list ("vlan 1,10") of VLAN 1 and the VLANs of the target
+    """
+    if RUNNING_CONFIG_DEFAULTS.match(text):
+        return True
+    if text.startswith("interface ") and len(children) == 0:
+        return True
+    match = re.match("^vlan ([\\d,-]+)$", text)
+    if match:
+        target_vlans = set([1])
+        for line in target:
+            target_match = re.match("^vlan ([\\d,-]+)$", line)
+            if target_match:
+                target_vlans.update(get_vlan_ids(target_match.group(1)))
+        return get_vlan_ids(match.group(1)).issubset(target_vlans)
+    return False
+
+
+def diff_config_trees(running, target, context=()):
+    """
+    Diffs two configuration trees (see config_tree_to_dict()) section by section.
+    Returns a list of (context, command, action, is_section): the mode commands to
+    enter, the command to run there, whether it adds or removes a line and whether
+    that line opens a section. Within a mode, the removals come before the additions.
+    The defaults of the running configuration (see is_running_config_default()) aren't
+    removed.
+    """
+    changes = []
+    # Removals first, so a changed line (e.g. another description) isn't removed after it is set
+    for text, children in running.items():
+        if text not in target:
+            if len(context) == 0 and is_running_config_default(text, children, target):
+                continue
+            command = text[3:] if text.startswith("no ") else "no %s" % text
+            changes.append((context, command, "remove", is_config_section(text, children)))
+    for text, children in target.items():
+        if text not in running:
+            changes.append((context, text, "add", is_config_section(text, children)))
+            changes.extend(diff_config_trees({}, children, context + (text,)))
+        else:
+            changes.extend(diff_config_trees(running[text], children, context + (text,)))
+    return changes
+
+
+def get_config_banner_lines(lines):
+    """
+    Gets the lines of the banners in configuration lines: "banner motd #" and the lines
+    up to the closing delimiter, or a one-line "banner motd #text#"
+    """
+    banner_lines = set()
+    delimiter = None
+    for line in lines:
+        text = line.strip()
+        if delimiter != None:
+            banner_lines.add(text)
+            if delimiter in text:
+                delimiter = None
+            continue
+        match = re.match("^banner \\S+ (\\S)(.*)$", text)
+        if match:
+            banner_lines.add(text)
+            if match.group(1) not in match.group(2):
+                delimiter = match.group(1)
+    return banner_lines
+
+
+def plan_config_diff(config_file):
+    """
+    Diffs the running configuration against the configuration file. Returns the changes
+    (see diff_config_trees()) if they are few and safe enough to apply live, None otherwise.
+    """
+    running_output = cli("show running-config")
+    if legacy:
+        running_output = running_output[1]
+    running_lines = running_output.split("\n")
+    running = config_tree_to_dict(parse_config_tree(running_lines))
+    with open(config_file, "r") as config_hdl:
+        target_lines = config_hdl.readlines()
+    target = config_tree_to_dict(parse_config_tree(target_lines))
+    banner_lines = get_config_banner_lines(running_lines) | get_config_banner_lines(target_lines)
+
+    # The version line differs between images and isn't configuration
+    for tree in [running, target]:
+        for text in list(tree.keys()):
+            if text.startswith("version "):
+                del tree[text]
+
+    changes = diff_config_trees(running, target)
+    poap_log("Running configuration differs from %s in %d line(s)" % (config_file, len(changes)))
+    if len(changes) > options["diff_max_changes"]:
+        poap_log("More than %d changed line(s), the configuration will be replaced" % options["diff_max_changes"])
+        return None
+
+    for context, command, action, is_section in changes:
+        section = context[0] if len(context) > 0 else command
+        # The commands of a mode are run joined with ";", and banners span several lines
+        if ";" in "".join(context + (command,)) or section in banner_lines or re.sub("^no ", "", command) in banner_lines:
+            poap_log("\"%s\" can't be run as a command, the configuration will be replaced" % command)
+            return None
+        if action == "remove" and is_section:
+            poap_log("Removing the section \"%s\" isn't done live, the configuration will be replaced" % command)
+            return None
+        if action == "remove" and len(context) == 0:
+            # e.g. a feature, a user or a route the file doesn't have anymore
+            poap_log("\"%s\" (a line only in the running configuration) isn't done live, the configuration "
+                     "will be replaced" % command)
+            return None
+        for unsafe in options["diff_unsafe_sections"]:
+            if re.sub("^no ", "", section).startswith(unsafe):
+                poap_log("Changes in \"%s\" aren't done live, the configuration will be replaced" % section)
+                return None
+    return changes
+
+
+def apply_config_diff():
+    """
+    In the "diff" config apply mode, applies only the changed lines of the configuration
+    file to the running configuration and saves it, instead of erasing the configuration
+    and scheduling the whole file. Returns False if the configuration has to be replaced
+    the usual way (other mode, too many or unsafe changes, or a failed command).
+    """
+    if options["config_apply_mode"] != "diff":
+        return False
+
+    fetch_config()
+    config_file = os.path.join(options["destination_path"], options["destination_config"])
+    try:
+        changes = plan_config_diff(config_file)
+    except Exception as e:
+        poap_log("Unable to diff the running configuration: %s" % str(e))
+        return False
+    if changes == None:
+        return False
+
+    # Apply the changes of each mode with one command
+    batches = []
+    for context, command, _, _ in changes:
+        if len(batches) > 0 and batches[-1][0] == context:
+            batches[-1][1].append(command)
+        else:
+            batches.append((context, [command]))
+
+    try:
+        for context, commands in batches:
+            config_cmd = " ; ".join(["configure terminal"] + list(context) + commands)
+            poap_log("Running command: %s" % config_cmd)
+            cli(config_cmd)
+        cli("config ; no boot poap enable")
+        time.sleep(5)
+        cli("copy running-config startup-config")
+        time.sleep(5)
+    except Exception as e:
+        poap_log("Failed to apply the configuration changes live: %s" % str(e))
+        return False
+
+    poap_log("Applied %d configuration change(s) live, the configuration isn't erased" % len(changes))
+    return True
+
+
+def fetch_config():
+    """
+    Copies switch configuration file and verifies if the md5 of the config
+    matches with the value present in .md5 file downloaded.
+    """
+    global options, config_fetched
+
+    if config_fetched:
+        return
+
+    poap_file = options["destination_config"]
+    config_file = os.path.join(options["destination_path"], poap_file)
+    config_file_with_colon = config_file.replace('/bootflash/', 'bootflash:', 1)
+
+    if os.path.exists(os.path.join(options["destination_path"], poap_file)):
+        poap_log("Configuration file already exists on bootflash")
+    else:
+        poap_log("Configuration file %s not found" % config_file_with_colon)
+        poap_log("Starting Copy of configuration file to: %s" % config_file)
+        tmp_file = "%s.tmp" % poap_file
+        timeout = options["timeout_config"]
+        src = os.path.join(options["config_path"], options["source_config_file"])
+        do_copy(src, poap_file, timeout, tmp_file)
+
+    if options["require_md5"] == True:
+        if options["source_config_md5"]:
+            # The MD5 came with the config index
+            md5_sum_given = options["source_config_md5"]
+        else:
+            copy_md5_info(options["config_path"], options["source_config_file"])
+            md5_sum_given = get_md5(options["source_config_file"])
+            # Remove poap.cfg.md5 after getting the MD5
+            poap_log("Saved MD5 checksum for %s" % os.path.join(options["destination_path"], "%s.md5" % options["source_config_file"]))
+            remove_file(os.path.join(options["destination_path"], "%s.md5" % options["source_config_file"]))
+        if verify_md5(md5_sum_given, config_file):
+            poap_log("Configuration apply can continue")
+        else:
+            abort("MD5 for configuration file %s failed!" % config_file_with_colon)
+
+    validate_config(config_file)
+
+    config_fetched = True
+
+
+def copy_config():
+    """
+    Copies the switch configuration file, if not fetched yet, and schedules it
+    """
+    poap_log("Starting application of configuration file")
+
+    fetch_config()
+
+    config_file = os.path.join(options["destination_path"], options["destination_config"])
+    config_file_with_colon = config_file.replace('/bootflash/', 'bootflash:', 1)
+    poap_log("The config file path is: " + config_file_with_colon)
+    poap_log("Copying configuration file to startup configuration")
+
+    try:
+        poap_log("Running command: copy %s scheduled-config" % config_file_with_colon)
+        cli("copy %s scheduled-config" % config_file_with_colon)
+        time.sleep(5)
+
+    except Exception as e:
+        poap_log("Could not copy configuration file to startup configuration!" % config_file_with_colon)
         abort(str(e))
 
     # Remove the configuration file after applying
@@ -1149,6 +2209,7 @@ def target_system_image_is_currently_running():
             global_copy_image = False 
             return True
         else:
+            sp = import_subprocess()
             if sp != None:
                 try: 
                     out = sp.check_output("file /isan/bin/pfm", stderr=sp.STDOUT, shell=True)
@@ -1315,6 +2376,272 @@ def install_images_7_x():
 
     poap_log("INFO: Configuration successful")
 
+def get_install_stage_key(stage):
+    """
+    Gets the name under which the duration of an install stage is kept. File names and
+    numbers are left out so the same stage matches across images.
+    """
+    return re.sub("\\d+", "N", re.sub("\\S+:\\S*", "<file>", stage)).strip()
+
+
+# Install stages that can show up without their progress line yet (e.g. "Performing runtime checks.")
+INSTALL_STAGE_PATTERN = re.compile("^(Verifying|Preparing|Performing|Notifying|Collecting|Setting|Saving|Copying|"
+                                   "Converting|Checking|Extracting|Pre-loading|Upgrading|Refreshing|Finishing|"
+                                   "Module \\d+: )[^\\[]*\\.$")
+INSTALL_PROGRESS_PATTERN = re.compile("\\[[# ]*\\]\\s*(\\d+)%(?:\\s*--\\s*(\\S+))?")
+
+
+def parse_install_status(output):
+    """
+    Parses the output of "show install all status" into a list of stages:
+    [{"stage": "Performing module support checks.", "percent": 100, "result": "SUCCESS"}]
+    A stage line is followed by a progress line like "[####################] 100% -- SUCCESS"
+    or is a known stage (see INSTALL_STAGE_PATTERN). Banners, the impact tables, warnings
+    between a stage and its progress line and the other messages of the installer are
+    not stages.
+    """
+    lines = [line.strip() for line in output.split("\n") if line.strip() != ""]
+    stages = []
+    awaiting_progress = False
+    for i, line in enumerate(lines):
+        match = INSTALL_PROGRESS_PATTERN.match(line)
+        if match:
+            if len(stages) > 0:
+                stages[-1]["percent"] = int(match.group(1))
+                stages[-1]["result"] = match.group(2) or ""
+            awaiting_progress = False
+        elif INSTALL_STAGE_PATTERN.match(line) or (
+                not awaiting_progress and i + 1 < len(lines) and INSTALL_PROGRESS_PATTERN.match(lines[i + 1])):
+            stages.append({"stage": line, "percent": 0, "result": ""})
+            awaiting_progress = True
+    return stages
+
+
+def estimate_install_time_left(history, stages, now, stage_started):
+    """
+    Estimates the seconds left until the install completes from the stage durations of
+    earlier installs. Returns None when there is no history yet.
+    """
+    if len(history.get("order", [])) == 0:
+        return None
+
+    seen = [get_install_stage_key(stage["stage"]) for stage in stages]
+    time_left = 0
+    for key in history["order"]:
+        if key in seen[:-1]:
+            continue
+        duration = history["stages"].get(key, {}).get("duration", 0)
+        if len(seen) > 0 and key == seen[-1]:
+            duration = max(duration - (now - stage_started), 0)
+        time_left += duration
+    return int(time_left)
+
+
+def record_install_stage(history, stage, duration):
+    """
+    Adds the duration of a finished install stage to the history on the bootflash. It is
+    written after every stage since the switch may reload before the install returns.
+    """
+    key = get_install_stage_key(stage)
+    stats = history["stages"].setdefault(key, {"duration": 0, "count": 0})
+    stats["duration"] = (stats["duration"] * stats["count"] + duration) / (stats["count"] + 1)
+    stats["count"] += 1
+    if key not in history["order"]:
+        history["order"].append(key)
+    write_poap_cache("install_stage_durations", history)
+
+
+def log_install_event(events, event, install_start):
+    """
+    Logs an install progress event and keeps the events of the install on the bootflash
+    ("install_progress" cache), so they are still there if the switch reloads
+    """
+    events.append(event)
+    message = "Install progress at %s (+%ds): stage %d %s: %s" % (
+        strftime("%H:%M:%S", gmtime(event["time"])), event["time"] - install_start,
+        event["index"], event["event"], event["stage"])
+    if event.get("result"):
+        message += " -- %s" % event["result"]
+    if event.get("time_left") != None:
+        message += ", about %ds left" % event["time_left"]
+    poap_log(message)
+    write_poap_cache("install_progress", {"start": install_start, "events": events})
+
+
+def run_install_with_progress(command):
+    """
+    Runs an install command in a thread and polls "show install all status" until it
+    returns. The polling backs off from "install_poll_interval" to
+    "install_poll_max_interval" seconds and starts over at every new stage. Each stage
+    start and end is logged as a progress event with the estimated time left.
+    """
+    result = {}
+
+    def install():
+        try:
+            result["output"] = cli(command)
+        except Exception as e:
+            result["error"] = e
+
+    install_thread = threading.Thread(target=install)
+    install_thread.daemon = True
+    install_thread.start()
+
+    history = read_poap_cache("install_stage_durations")
+    history.setdefault("stages", {})
+    history.setdefault("order", [])
+
+    install_start = time.time()
+    stage_started = install_start
+    interval = options["install_poll_interval"]
+    stages = []
+    events = []
+
+    while True:
+        install_thread.join(interval)
+        finished = not install_thread.is_alive()
+
+        try:
+            output = cli("show install all status")
+            if legacy:
+                output = output[1]
+            current = parse_install_status(output)
+        except Exception as e:
+            poap_log("Unable to read the install status: %s" % str(e))
+            current = stages
+
+        now = time.time()
+        for i in range(len(stages), len(current)):
+            if i > 0:
+                record_install_stage(history, current[i - 1]["stage"], now - stage_started)
+                log_install_event(events, {"time": now, "index": i, "stage": current[i - 1]["stage"],
+                                           "event": "finished", "result": current[i - 1]["result"]},
+                                  install_start)
+            stage_started = now
+            log_install_event(events, {"time": now, "index": i + 1, "stage": current[i]["stage"], "event": "started",
+                                       "time_left": estimate_install_time_left(history, current[:i + 1], now,
+                                                                               stage_started)},
+                              install_start)
+
+        if finished:
+            break
+
+        if len(current) > len(stages):
+            interval = options["install_poll_interval"]
+        else:
+            interval = min(interval * 2, options["install_poll_max_interval"])
+            if len(current) > 0:
+                time_left = estimate_install_time_left(history, current, now, stage_started)
+                poap_log("Install progress (+%ds): stage %d at %d%%%s" % (
+                    now - install_start, len(current), current[-1]["percent"],
+                    "" if time_left == None else ", about %ds left" % time_left))
+        stages = current
+
+    stages = current
+    if len(stages) > 0:
+        now = time.time()
+        record_install_stage(history, stages[-1]["stage"], now - stage_started)
+        log_install_event(events, {"time": now, "index": len(stages), "stage": stages[-1]["stage"],
+                                   "event": "finished", "result": stages[-1]["result"]}, install_start)
+    poap_log("Install returned after %ds (%d stage(s))" % (time.time() - install_start, len(stages)))
+
+    if "error" in result:
+        raise result["error"]
+    return result.get("output")
+
+
+def get_install_image_path():
+    """
+    Gets the image "install all" runs with (see install_nxos_issu), e.g. bootflash:nxos.9.3.8.bin
+    """
+    if global_copy_image:
+        system_image_path = os.path.join(options["destination_path"], options["upgrade_system_image"])
+        return system_image_path.replace("/bootflash/", "bootflash:", 1)
+    # The booted image, as found by get_currently_booted_image_filename()
+    return "bootflash:%s" % nxos_filename
+
+
+def parse_install_impact(output):
+    """
+    Parses the module table of "show install all impact" into a list of
+    {"module": "1", "bootable": "yes", "impact": "disruptive", "install_type": "reset", "reason": "..."}
+    """
+    modules = []
+    for line in output.split("\n"):
+        match = re.match("\\s*(\\d+)\\s+(yes|no)\\s+(\\S+)\\s+(\\S+)\\s*(.*)$", line)
+        if match:
+            modules.append({"module": match.group(1), "bootable": match.group(2), "impact": match.group(3),
+                            "install_type": match.group(4), "reason": match.group(5).strip()})
+    return modules
+
+
+def check_install_impact(result):
+    """
+    Runs "show install all impact nxos <image>" and stores the modules of the impact
+    table in result["modules"]. The result is cached on the bootflash by image MD5 and
+    running NX-OS version, so later runs with the same image skip the check. If the
+    check can't be done, result["error"] says why.
+    """
+    try:
+        image_path = get_install_image_path()
+        image_file = image_path.replace("bootflash:", "/bootflash/", 1)
+
+        try:
+            image_md5 = get_verified_md5(image_file) or compute_md5(image_file)
+        except (IOError, OSError) as e:
+            result["error"] = "Unable to read %s: %s" % (image_file, str(e))
+            return
+        key = "%s_%s" % (image_md5, nxos_version)
+
+        with cache_lock:
+            cached = read_poap_cache("install_impact").get(key)
+        if cached != None:
+            poap_log("Using the cached install impact of %s (MD5 %s)" % (image_path, image_md5))
+            result["modules"] = cached
+            return
+
+        start = time.time()
+        output = cli("show install all impact nxos %s" % image_path)
+        if legacy:
+            output = output[1]
+        result["modules"] = parse_install_impact(output)
+        poap_log("Install impact check of %s took %ds" % (image_path, time.time() - start))
+
+        if len(result["modules"]) > 0:
+            with cache_lock:
+                cache = read_poap_cache("install_impact")
+                cache[key] = result["modules"]
+                write_poap_cache("install_impact", cache)
+    except Exception as e:
+        result["error"] = str(e) or type(e).__name__
+
+
+def precheck_install():
+    """
+    Checks the install impact once the image is on the bootflash and aborts, before the
+    configuration is erased, if a module wouldn't boot the image or, with
+    "abort_on_disruptive_install", if the install would be disruptive.
+    """
+    if options["install_impact_check"] == False:
+        return
+
+    result = {}
+    check_install_impact(result)
+
+    if "error" in result:
+        poap_log("WARN: Unable to check the install impact: %s" % result["error"])
+        return
+
+    for module in result["modules"]:
+        poap_log("Install impact: module %s bootable %s, %s (%s) %s" % (module["module"], module["bootable"],
+                                                                       module["impact"], module["install_type"],
+                                                                       module["reason"]))
+        if module["bootable"] != "yes":
+            abort("Module %s cannot boot the image: %s" % (module["module"], module["reason"]))
+        if module["impact"] == "disruptive" and options["abort_on_disruptive_install"] == True:
+            abort("The install would be disruptive on module %s: %s" % (module["module"], module["reason"]))
+
+
 def install_nxos_issu():
     ''' 
        global_copy_image is false implies that currently running and target_iamge
@@ -1327,12 +2654,10 @@ def install_nxos_issu():
 
     global options
 
+    system_image_path = get_install_image_path()
     if global_copy_image:
-        system_image_path = os.path.join(options["destination_path"], options["upgrade_system_image"])
-        system_image_path = system_image_path.replace("/bootflash/", "bootflash:", 1)
         poap_log("The upgrade system image path is: " + system_image_path)
     else:
-        system_image_path = os.path.join("bootflash:",get_currently_booted_image_filename())
         poap_log("The currently booted image filename is: " + system_image_path)
     
 
@@ -1347,7 +2672,7 @@ def install_nxos_issu():
         os.system("touch /tmp/poap_issu_started")
         poap_log("The script will run the following install command:")
         poap_log("terminal dont-ask ; install all nxos %s non-interruptive" % system_image_path)
-        cli("terminal dont-ask ; install all nxos %s non-interruptive" % system_image_path)
+        run_install_with_progress("terminal dont-ask ; install all nxos %s non-interruptive" % system_image_path)
         time.sleep(5)
         #cli("terminal dont-ask ; write erase")
         #time.sleep(5)
@@ -1427,9 +2752,268 @@ def install_issu():
         poap_log("%0.2f%% bootflash free" % percent_free)
         abort("Image install failed: %s" % str(e))
         
-def parse_poap_yaml():
+RECIPE_FILE = "/bootflash/poap_device_recipe.yaml"
+
+# Keys allowed in the device recipe and the type of their value
+RECIPE_SCHEMA = {
+    "Version": int,
+    "Target_image": str,
+    "License": list,
+    "RPM": list,
+    "Certificate": list,
+    "Trustpoint": dict,
+}
+
+
+def validate_device_recipe(dictionary):
     """
-    Parses the <serial_number>.yaml file and populates the dictionary
+    Validates the device recipe against RECIPE_SCHEMA in a single pass.
+    Returns the list of all the errors found (empty if the recipe is valid).
+    """
+    if not isinstance(dictionary, dict):
+        return ["The device recipe must be a YAML mapping"]
+
+    errors = []
+    wrong_files = []
+    for key, value in dictionary.items():
+        if key not in RECIPE_SCHEMA:
+            errors.append("Unknown key %s (expected one of %s)" % (key, ", ".join(RECIPE_SCHEMA.keys())))
+        elif value == None:
+            errors.append("Key {} has value None. Remove unwanted keys from yaml file.".format(key))
+        elif not isinstance(value, RECIPE_SCHEMA[key]):
+            errors.append("Key %s must be a %s" % (key, RECIPE_SCHEMA[key].__name__))
+
+    if "Version" not in dictionary:
+        errors.append("Version keyword not found in yaml. Cannot proceed with installation.")
+    elif dictionary["Version"] != 1:
+        errors.append("Version given is not 1. Cannot be parsed for installation.")
+
+    for key, extensions in [("License", (".lic",)), ("RPM", (".rpm",)), ("Certificate", None)]:
+        if not isinstance(dictionary.get(key), list):
+            continue
+        for artifact in dictionary[key]:
+            if not isinstance(artifact, str):
+                errors.append("%s entry %s must be a filename" % (key, artifact))
+            elif extensions != None and not artifact.strip().endswith(extensions):
+                wrong_files.append(artifact.strip())
+
+    if isinstance(dictionary.get("Trustpoint"), dict):
+        for ca, certs in dictionary["Trustpoint"].items():
+            if not isinstance(certs, dict):
+                errors.append("Trustpoint %s must map certificate files to their passwords" % ca)
+                continue
+            for cert in certs.keys():
+                if not str(cert).strip().endswith(('.pfx', '.p12')):
+                    wrong_files.append(str(cert).strip())
+
+    if len(wrong_files) > 0:
+        errors.append("Expected extensions are .lic for licenses, .rpm for RPM files and .pfx or .p12 for Trustpoint based certificates.")
+        errors.append("The below files have wrong extension. Please rename in rpm source location and update YAML file accordingly.")
+        errors += wrong_files
+
+    return errors
+
+
+def freeze_recipe(value):
+    """
+    Makes a parsed recipe immutable, so every consumer sees the same data
+    """
+    import types
+
+    if isinstance(value, dict):
+        return types.MappingProxyType(dict((key, freeze_recipe(item)) for key, item in value.items()))
+    elif isinstance(value, list):
+        return tuple(freeze_recipe(item) for item in value)
+    return value
+
+
+def load_device_recipe():
+    """
+    Loads and validates the device recipe (/bootflash/poap_device_recipe.yaml) once and
+    returns it as an immutable object. The parsed recipe is cached on the bootflash
+    together with the MD5 of the YAML file, so later hops don't parse it again.
+    Aborts with all the validation errors if the recipe isn't valid.
+    """
+    global device_recipe
+
+    with open(RECIPE_FILE, "rb") as stream:
+        data = stream.read()
+    digest = hashlib.md5(data).hexdigest()
+
+    if device_recipe != None and device_recipe[0] == digest:
+        return device_recipe[1]
+
+    cache = read_poap_cache("device_recipe")
+    if cache.get("digest") == digest:
+        poap_log("Using cached device recipe (MD5 %s)" % digest)
+        dictionary = cache["recipe"]
+    else:
+        import yaml
+
+        # The C loader is much faster than the pure Python one when it is available
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+        try:
+            dictionary = yaml.load(data, Loader=loader)
+        except yaml.YAMLError as e:
+            abort("Unable to parse device recipe: %s" % str(e))
+
+        errors = validate_device_recipe(dictionary)
+        if len(errors) > 0:
+            for error in errors:
+                poap_log(error)
+            abort("Device recipe has %d error(s)" % len(errors))
+        write_poap_cache("device_recipe", {"digest": digest, "recipe": dictionary})
+
+    device_recipe = (digest, freeze_recipe(dictionary))
+    return device_recipe[1]
+
+
+# Fleet recipe index layout (see build_fleet_index()):
+#   header: "POAPIDX2 <bucket count>", padded to FLEET_INDEX_HEADER_SIZE bytes
+#   slots:  one "<offset> <length>" slot of FLEET_INDEX_SLOT_SIZE bytes per bucket
+#   blocks: one JSON object per bucket mapping serial numbers to their entry
+# The header and the slots fit in the first FLEET_INDEX_DIRECTORY_SIZE bytes, so a
+# lookup reads those and then the one bucket (if it isn't in them already).
+FLEET_INDEX_MAGIC = "POAPIDX2"
+FLEET_INDEX_HEADER_SIZE = 32
+FLEET_INDEX_SLOT_SIZE = 24
+FLEET_INDEX_DIRECTORY_SIZE = 8192
+FLEET_INDEX_MAX_BUCKETS = (FLEET_INDEX_DIRECTORY_SIZE - FLEET_INDEX_HEADER_SIZE) // FLEET_INDEX_SLOT_SIZE
+
+
+class RangeRequestIgnored(IOError):
+    """
+    Raised by read_remote_range() when the file server answers a range request with
+    the whole file
+    """
+    pass
+
+
+def fleet_index_bucket(serial, bucket_count):
+    """
+    Gets the bucket of a serial number in the fleet recipe index
+    """
+    return int(hashlib.md5(serial.encode()).hexdigest()[:8], 16) % bucket_count
+
+
+def build_fleet_index(entries, bucket_count=None):
+    """
+    Builds a fleet recipe index from a dictionary of serial number to entry. An entry
+    is {"md5": <md5 of the recipe>, "recipe": <recipe YAML>} for embedded recipes or
+    {"md5": <md5 of the recipe>, "path": <recipe path relative to install_path>}.
+    Used by poap_server_tool.py to generate the index on the file server.
+    """
+    if bucket_count == None:
+        bucket_count = min(max(1, len(entries) // 8), FLEET_INDEX_MAX_BUCKETS)
+    if bucket_count > FLEET_INDEX_MAX_BUCKETS:
+        raise ValueError("a fleet recipe index has at most %d buckets" % FLEET_INDEX_MAX_BUCKETS)
+
+    buckets = [{} for i in range(bucket_count)]
+    for serial, entry in entries.items():
+        buckets[fleet_index_bucket(serial, bucket_count)][serial] = entry
+
+    blocks = [json.dumps(bucket, sort_keys=True).encode() + b"\n" for bucket in buckets]
+    header = ("%s %d" % (FLEET_INDEX_MAGIC, bucket_count)).ljust(FLEET_INDEX_HEADER_SIZE - 1) + "\n"
+    offset = FLEET_INDEX_HEADER_SIZE + FLEET_INDEX_SLOT_SIZE * bucket_count
+    slots = []
+    for block in blocks:
+        slots.append(("%d %d" % (offset, len(block))).ljust(FLEET_INDEX_SLOT_SIZE - 1) + "\n")
+        offset += len(block)
+    return header.encode() + "".join(slots).encode() + b"".join(blocks)
+
+
+def read_fleet_index_entry(read_range, serial):
+    """
+    Looks up a serial number in a fleet recipe index. read_range(offset, length) returns
+    bytes of the index. The first FLEET_INDEX_DIRECTORY_SIZE bytes (header and slots)
+    are read, then the bucket of the serial number unless it was in them already.
+    Returns the entry of the serial number or None.
+    """
+    directory = read_range(0, FLEET_INDEX_DIRECTORY_SIZE)
+    header = byte2str(directory[:FLEET_INDEX_HEADER_SIZE]).split()
+    if len(header) != 2 or header[0] != FLEET_INDEX_MAGIC:
+        raise ValueError("not a POAP fleet recipe index (rebuild it with poap_server_tool.py fleet-index)")
+
+    bucket = fleet_index_bucket(serial, int(header[1]))
+    slot_start = FLEET_INDEX_HEADER_SIZE + FLEET_INDEX_SLOT_SIZE * bucket
+    slot = byte2str(directory[slot_start:slot_start + FLEET_INDEX_SLOT_SIZE]).split()
+    offset, length = int(slot[0]), int(slot[1])
+    if offset + length <= len(directory):
+        block = directory[offset:offset + length]
+    else:
+        block = read_range(offset, length)
+    return json.loads(byte2str(block)).get(serial)
+
+
+def read_remote_range(path, offset, length):
+    """
+    Reads part of a file on the HTTP(S) file server with a range request. Raises
+    RangeRequestIgnored if the server sends the whole file instead.
+    """
+    response = open_remote_url(path, headers={"Range": "bytes=%d-%d" % (offset, offset + length - 1)},
+                               timeout=options["timeout_config"])
+    try:
+        if response.status != 206:
+            raise RangeRequestIgnored("%s doesn't support range requests (HTTP %d)" % (path, response.status))
+        return response.read(length)
+    finally:
+        response.close()
+
+
+def fetch_recipe_from_index():
+    """
+    Finds the recipe of this switch in the fleet recipe index ("recipe_index") and
+    writes it to the bootflash. Over HTTP(S) only the directory and this switch's
+    bucket of the index are fetched with range requests. If the server doesn't support
+    them, the recipe is downloaded from the serial number directory instead, see
+    fetch_recipe_from_serial_directory(). Otherwise the index is downloaded once.
+    Returns False if the switch isn't in the index.
+    """
+    index_path = options["recipe_index"]
+    serial = options["serial_number"]
+    poap_log("Looking up %s in fleet recipe index %s" % (serial, index_path))
+
+    try:
+        if options["transfer_protocol"] in ["http", "https"] and os.environ.get("POAP_PHASE", None) != "USB":
+            try:
+                entry = read_fleet_index_entry(lambda offset, length: read_remote_range(index_path, offset, length), serial)
+            except RangeRequestIgnored as e:
+                poap_log("WARN: %s, downloading the recipe from the serial number directory instead" % str(e))
+                return fetch_recipe_from_serial_directory()
+        else:
+            dst = "poap_recipe_index.idx"
+            do_copy(index_path, dst, options["timeout_config"], "%s.tmp" % dst)
+            with open(os.path.join(options["destination_path"], dst), "rb") as index_hdl:
+                def read_local_range(offset, length):
+                    index_hdl.seek(offset)
+                    return index_hdl.read(length)
+                entry = read_fleet_index_entry(read_local_range, serial)
+            remove_file(os.path.join(options["destination_path"], dst))
+    except (IOError, OSError, ValueError) as e:
+        abort("Unable to read fleet recipe index %s: %s" % (index_path, str(e)))
+
+    if entry == None:
+        return False
+
+    if "recipe" in entry:
+        with open(RECIPE_FILE, "wb") as recipe_hdl:
+            recipe_hdl.write(entry["recipe"].encode("utf-8"))
+    else:
+        dst = os.path.basename(RECIPE_FILE)
+        do_copy(os.path.join(options["install_path"], entry["path"]), dst, options["timeout_config"], "%s.tmp" % dst)
+
+    if options["require_md5"] == True:
+        md5_calculated = compute_md5(RECIPE_FILE)
+        if md5_calculated != entry.get("md5"):
+            abort("#### Yaml file %s MD5 verification failed #####\n" % RECIPE_FILE)
+        record_verified_md5(RECIPE_FILE, md5_calculated)
+    return True
+
+
+def fetch_recipe_from_serial_directory():
+    """
+    Downloads <install_path>/<serial_number>/<serial_number>.yaml (or .yml).
+    Returns False if neither exists.
     """
     copy_path = options["install_path"] + "/" + options["serial_number"] + "/" + options["serial_number"] + ".yaml"
     alt_path = options["install_path"] + "/" + options["serial_number"] + "/" + options["serial_number"] + ".yml"
@@ -1472,24 +3056,27 @@ def parse_poap_yaml():
                     time.sleep(2)
         except:
             if md5_verification:
-                poap_log("Although 'install_path' is set in poap script file, proceeding with legacy poap workflow because yaml file for device is not found")
-                options["install_path"] = ""
-                return
+                return False
         if not md5_verification:
             exit(1)
-    stream = open("/bootflash/poap_device_recipe.yaml", 'r')
-    dictionary = yaml.load(stream)
-    none_value_found = False
-    for k in dictionary.keys():
-        if dictionary[k] == None:
-            none_value_found = True
-            poap_log("Key {} has value None".format(k))
-    if none_value_found:
-        abort("Yaml has got keys with value None. Remove unwanted keys from yaml file.")
-    if ("Version" not in dictionary):
-        abort("Version keyword not found in yaml. Cannot proceed with installation.")
-    elif ("Version" in dictionary and dictionary["Version"] != 1):
-        abort("Version given is not 1. Cannot be parsed for installation.")
+    return True
+
+
+def parse_poap_yaml():
+    """
+    Parses the <serial_number>.yaml file and populates the dictionary
+    """
+    if options["recipe_index"]:
+        found = fetch_recipe_from_index()
+    else:
+        found = fetch_recipe_from_serial_directory()
+
+    if not found:
+        poap_log("Although 'install_path' is set in poap script file, proceeding with legacy poap workflow because yaml file for device is not found")
+        options["install_path"] = ""
+        return
+
+    dictionary = load_device_recipe()
     if ("Target_image" in dictionary):
         options["target_system_image"] = dictionary["Target_image"]
         options["destination_system_image"] = dictionary["Target_image"]
@@ -1498,205 +3085,606 @@ def parse_poap_yaml():
 def validate_yaml_file():
     """
     Validates all the input filenames in the yaml file and throws error
-    for wrong extension/rpm filename format.
+    for wrong extension/rpm filename format. The validation itself is done
+    once when the recipe is loaded (see validate_device_recipe()).
     """
-    stream = open("/bootflash/poap_device_recipe.yaml", 'r')
-    dictionary = yaml.load(stream)
-    wrong_files = []
+    load_device_recipe()
 
-    if ("License" in dictionary):
-        for lic in dictionary["License"]:
-             lic = lic.strip()
-             if not lic.endswith('.lic'):
-                 wrong_files += [lic]
-    if ("RPM" in dictionary):
-        for rpm in dictionary["RPM"]:
-             rpm = rpm.strip()
-             if not rpm.endswith('.rpm'):
-                 wrong_files += [rpm]
+        
+def get_artifact_timeout(size):
+    """
+    Gets the copy timeout for a file of the given size (in bytes), assuming the
+    transfer is at least as fast as "min_transfer_rate" (MB/s). Files of unknown
+    size get the system image timeout.
+    """
+    if size == None:
+        return options["timeout_copy_system"]
+    timeout = options["timeout_config"] + size / (options["min_transfer_rate"] * 1024 * 1024)
+    return int(min(timeout, options["timeout_copy_system"]))
 
-    if ("Trustpoint" in dictionary):
-        for ca in dictionary["Trustpoint"].keys():
-            for cert, crypto_pass in dictionary["Trustpoint"][ca].items():
-                cert = cert.strip()
-                if not (cert.endswith('.pfx') or cert.endswith('.p12')):
-                    wrong_files += [cert]
 
-    if len(wrong_files) > 0:
-        poap_log("Expected extensions are .lic for licenses, .rpm for RPM files and .pfx or .p12 for Trustpoint based certificates.")
-        poap_log("The below files have wrong extension. Please rename in rpm source location and update YAML file accordingly.")
-        for file in wrong_files:
-            poap_log(file)
-        abort()
+def get_artifact_md5(source, dst):
+    """
+    Gets the expected MD5 of a recipe artifact from the manifest, or from its .md5
+    file on the server (downloaded next to /bootflash/<dst>). Returns None if there
+    is no MD5 for it.
+    """
+    entry = get_manifest_entry(source)
+    if entry != None and entry.get("md5"):
+        return entry["md5"]
+
+    # Named after the destination, since artifacts of different Trustpoint CAs can share a
+    # file name and their .md5 files are downloaded at the same time
+    md5_file_name = "%s.md5" % dst
+    try:
+        do_copy("%s.md5" % source, md5_file_name, options["timeout_config"], "%s.tmp" % md5_file_name, False, True)
+        md5_sum_given = get_md5(os.path.basename(source), True, md5_file_name)
+    except Exception:
+        return None
+    finally:
+        remove_file(os.path.join(options["destination_path"], md5_file_name))
+    return md5_sum_given or None
+
+
+def download_recipe_artifact(source, dst):
+    """
+    Downloads one recipe artifact to /bootflash/<dst> and verifies its MD5.
+    Runs in a worker thread of download_recipe_artifacts().
+    """
+    timeout = get_artifact_timeout(get_remote_file_size(source))
+    md5_sum_given = get_artifact_md5(source, dst) if options["require_md5"] == True else None
+
+    do_copy(source, dst, timeout, "%s.tmp" % dst, False)
+
+    if options["require_md5"] == True:
+        filename = os.path.join(options["destination_path"], dst)
+        if md5_sum_given == None:
+            poap_log("WARN: No MD5 found for %s, skipping MD5 verification" % source)
+            return
+        md5_calculated = compute_md5(filename)
+        if md5_calculated != md5_sum_given:
+            raise POAPError("MD5 mis-match for file %s (given %s, calculated %s)" % (filename, md5_sum_given, md5_calculated))
+        record_verified_md5(filename, md5_calculated)
+        poap_log("MD5 match for file: %s" % filename)
+
+
+def download_recipe_artifacts(artifacts):
+    """
+    Downloads the recipe artifacts, given as a list of (server path, destination)
+    pairs, with a pool of "recipe_download_workers" threads. Aborts once all the
+    downloads have finished if any of them failed, listing every failed artifact.
+    """
+    import concurrent.futures
+
+    if len(artifacts) == 0:
+        return
+
+    poap_log("Downloading %d recipe artifact(s) with %d worker(s)" % (len(artifacts), options["recipe_download_workers"]))
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options["recipe_download_workers"]) as pool:
+        futures = dict((pool.submit(download_recipe_artifact, source, dst), source) for source, dst in artifacts)
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                failures.append((futures[future], e))
+
+    if len(failures) > 0:
+        for source, e in failures:
+            poap_log("ERROR: Failed to download %s: %s" % (source, str(e)))
+        abort("Failed to download %d of %d recipe artifact(s)" % (len(failures), len(artifacts)))
+
 
-        
 def copy_poap_files():
     """
     Copies all the files as per the yaml file and places them in poap_files
     """
-    stream = open("/bootflash/poap_device_recipe.yaml", 'r')
-    dictionary = yaml.load(stream)
+    dictionary = load_device_recipe()
     os.system("mkdir -p /bootflash/poap_files")
-    timeout = options["timeout_copy_system"]
+    artifacts = []
+
+    for key in ["License", "RPM", "Certificate"]:
+        if (key in dictionary):
+            for artifact in dictionary[key]:
+                artifact = artifact.strip()
+                artifacts.append((os.path.join(options["install_path"], artifact),
+                                  "poap_files/" + artifact.split('/')[-1]))
+    if ("Trustpoint" in dictionary):
+        for ca in dictionary["Trustpoint"].keys():
+            tmp_cmd = "mkdir -p /bootflash/poap_files/" + ca
+            os.system(tmp_cmd)
+            for tp_cert, crypto_pass in dictionary["Trustpoint"][ca].items():
+                tp_cert = tp_cert.strip()
+                artifacts.append((os.path.join(options["install_path"], tp_cert),
+                                  "poap_files/" + ca + "/" + tp_cert.split('/')[-1]))
+
+    download_recipe_artifacts(artifacts)
+
+    if ("RPM" in dictionary):
+        rpm_error = False
+        for rpm in dictionary["RPM"]:
+            rpm = rpm.strip()
+            rpm_info = get_rpm_metadata(rpm.split('/')[-1])
+            orig_name = "%s-%s-%s.%s.rpm" % (rpm_info["name"], rpm_info["version"], rpm_info["release"], rpm_info["arch"])
+            if (orig_name != rpm.split('/')[-1]):
+                poap_log ("ERROR : RPM file %s does not match RPM package naming convention. Expected name: %s" %(rpm.split('/')[-1],orig_name))
+                rpm_error = True
+        if rpm_error:
+            abort("Please correct the above rpm files in rpm source location and update YAML file accordingly.")
+
+   
+def install_license():
+    """
+    Installs the license files.
+    """
+
+    conf_file_second = os.path.join("/bootflash", options["split_config_second"])
+    tmp_file_second = conf_file_second + ".tmp"
+    tmp_file_write = open(tmp_file_second, 'w')
+    for file in os.listdir(os.path.join(options["destination_path"], "poap_files")):
+        if file.endswith(".lic"):
+            poap_log("Installing license file: %s" % file)
+            conf_file_second = os.path.join("/bootflash", options["split_config_second"])
+            tmp_file_second = conf_file_second + ".tmp"
+
+            tmp_file_write.write("install license bootflash:poap_files/%s\n" % file)
+            poap_log("Installed license succesfully.")
+    tmp_file_write.close()
+    import shutil
+    with open(conf_file_second, 'r') as read_file, open (tmp_file_second, 'a+') as write_file:
+        shutil.copyfileobj(read_file, write_file, 1024 * 1024)
+    os.rename(tmp_file_second, conf_file_second)
+
+    poap_log("Installed all licenses succesfully.")
+
+            
+def check_if_rpm_in_file(file_name, rpm):
+    """
+    Check if any line in the file contains given rpm
+    """
+    if(not(os.path.exists(file_name))):
+        return True
+    with open(file_name, 'r') as read_obj:
+        for line in read_obj:
+            if rpm in line:
+                return True
+    return False
+
+
+# RPM header tags read by read_rpm_header()
+RPM_TAG_NAME = 1000
+RPM_TAG_VERSION = 1001
+RPM_TAG_RELEASE = 1002
+RPM_TAG_GROUP = 1016
+RPM_TAG_ARCH = 1022
+
+RPM_TYPE_STRING = 6
+RPM_TYPE_STRING_ARRAY = 8
+RPM_TYPE_I18NSTRING = 9
+
+
+def read_rpm_header_structure(rpm_hdl):
+    """
+    Reads one header structure (signature or main header) at the current position
+    of the RPM file. Returns the list of index entries and the data store.
+    """
+    import struct
+
+    intro = rpm_hdl.read(16)
+    if len(intro) != 16 or intro[0:3] != b"\x8e\xad\xe8":
+        raise ValueError("bad header magic")
+    index_count, store_size = struct.unpack(">II", intro[8:16])
+    index = rpm_hdl.read(16 * index_count)
+    store = rpm_hdl.read(store_size)
+    if len(index) != 16 * index_count or len(store) != store_size:
+        raise ValueError("truncated header")
+    entries = [struct.unpack(">iiii", index[i:i + 16]) for i in range(0, len(index), 16)]
+    return entries, store, 16 + len(index) + store_size
+
+
+def read_rpm_header(filename):
+    """
+    Reads the string tags of an RPM main header in Python, without running "rpm -qp".
+    Only the lead and the headers are read, not the payload. Returns a dictionary of
+    tag number to value (the first string for string arrays and i18n strings).
+    """
+    with open(filename, "rb") as rpm_hdl:
+        lead = rpm_hdl.read(96)
+        if len(lead) != 96 or lead[0:4] != b"\xed\xab\xee\xdb":
+            raise ValueError("%s is not an RPM file" % filename)
+
+        # The signature header is padded to a multiple of 8 bytes
+        entries, store, size = read_rpm_header_structure(rpm_hdl)
+        rpm_hdl.read((8 - size % 8) % 8)
+
+        entries, store, size = read_rpm_header_structure(rpm_hdl)
+
+    tags = {}
+    for tag, tag_type, offset, count in entries:
+        if tag_type in [RPM_TYPE_STRING, RPM_TYPE_STRING_ARRAY, RPM_TYPE_I18NSTRING]:
+            end = store.find(b"\x00", offset)
+            tags[tag] = byte2str(store[offset:end if end != -1 else len(store)])
+    return tags
+
+
+def get_nxos_rpm_type(filename, tags):
+    """
+    Gets the NXOSRPMTYPE of an RPM from its header tags. NXOSRPMTYPE is a Cisco specific
+    RPM tag, so its tag number isn't fixed. It can be set with the "rpm_nxos_type_tag"
+    option. Otherwise the type is queried with "rpm -qp" and matched against the header
+    of the RPM, and the tag number is remembered on the bootflash for later runs. If the
+    tag number can't be matched (the RPM has no NXOSRPMTYPE, or several tags have its
+    value), the queried type is used and remembered for this RPM.
+    """
+    if options["rpm_nxos_type_tag"] != None:
+        return tags.get(options["rpm_nxos_type_tag"], "")
+
+    cache = read_poap_cache("rpm_tags")
+    if "NXOSRPMTYPE" in cache:
+        options["rpm_nxos_type_tag"] = cache["NXOSRPMTYPE"]
+        return tags.get(options["rpm_nxos_type_tag"], "")
+
+    rpm_id = "%s-%s-%s.%s" % (tags.get(RPM_TAG_NAME, ""), tags.get(RPM_TAG_VERSION, ""),
+                              tags.get(RPM_TAG_RELEASE, ""), tags.get(RPM_TAG_ARCH, ""))
+    rpm_types = cache.setdefault("rpm_types", {})
+    if rpm_id in rpm_types:
+        return rpm_types[rpm_id]
+
+    sp = import_subprocess()
+    if sp == None:
+        return ""
+    try:
+        rpm_type = byte2str(sp.check_output(["/usr/bin/rpm", "-qp", "--queryformat", "%{NXOSRPMTYPE}", filename])).strip()
+    except Exception as e:
+        poap_log("WARN: Unable to query NXOSRPMTYPE of %s: %s" % (filename, str(e)))
+        return ""
+    if rpm_type == "(none)":
+        rpm_type = ""
+
+    matches = [tag for tag, value in tags.items() if value == rpm_type and tag > RPM_TAG_ARCH]
+    if len(rpm_type) > 0 and len(matches) == 1:
+        poap_log("NXOSRPMTYPE is RPM tag %d" % matches[0])
+        options["rpm_nxos_type_tag"] = matches[0]
+        cache["NXOSRPMTYPE"] = matches[0]
+    else:
+        # This RPM doesn't tell us which tag it is, the next one will be queried again
+        rpm_types[rpm_id] = rpm_type
+    write_poap_cache("rpm_tags", cache)
+    return rpm_type
+
+
+def get_rpm_metadata(file):
+    """
+    Gets the NAME, VERSION, RELEASE, ARCH, GROUP and NXOSRPMTYPE of an RPM in
+    /bootflash/poap_files. The result is stored in a sidecar file in the same
+    directory, so the install and the rollback only read each RPM once.
+    """
+    filename = os.path.join("/bootflash/poap_files", file)
+    sidecar = "/bootflash/poap_files/.rpm_metadata.json"
+    stats = os.stat(filename)
+
+    try:
+        with open(sidecar, "r") as sidecar_hdl:
+            metadata = json.load(sidecar_hdl)
+    except (IOError, OSError, ValueError):
+        metadata = {}
+
+    entry = metadata.get(file)
+    if entry != None and entry["size"] == stats.st_size and entry["mtime"] == stats.st_mtime:
+        return entry
+
+    tags = read_rpm_header(filename)
+    entry = {
+        "name": tags.get(RPM_TAG_NAME, ""),
+        "version": tags.get(RPM_TAG_VERSION, ""),
+        "release": tags.get(RPM_TAG_RELEASE, ""),
+        "arch": tags.get(RPM_TAG_ARCH, ""),
+        "group": tags.get(RPM_TAG_GROUP, ""),
+        "nxos_rpm_type": get_nxos_rpm_type(filename, tags),
+        "size": stats.st_size,
+        "mtime": stats.st_mtime,
+    }
+    metadata[file] = entry
+    with open(sidecar, "w") as sidecar_hdl:
+        json.dump(metadata, sidecar_hdl)
+    return entry
+
+
+# RPM repositories on the active supervisor, see get_standby_path() for the standby
+RPM_REPOS = {
+    "patch": "/bootflash/.rpmstore/patching/patchrepo/",
+    "feature": "/bootflash/.rpmstore/patching/localrepo/",
+    "thirdparty": "/bootflash/.rpmstore/thirdparty/",
+}
+
+
+def get_standby_path(path):
+    """
+    Gets the path of a bootflash file or directory on the standby supervisor
+    """
+    return path.replace("/bootflash/", "/bootflash_sup-remote/", 1)
+
+
+def copy_file_data(src, dst, buffer_size=4 * 1024 * 1024, md5=None):
+    """
+    Copies the content of a file in the kernel, with copy_file_range() or else
+    sendfile(), when the platform supports it between the two file systems. Otherwise
+    (or if an md5 object is given, to be updated with the data on the way) it copies
+    with large buffers. Returns the number of bytes copied.
+    """
+    copied = 0
+    with open(src, "rb") as src_hdl, open(dst, "wb") as dst_hdl:
+        if md5 == None:
+            for kernel_copy in ["copy_file_range", "sendfile"]:
+                if not hasattr(os, kernel_copy):
+                    continue
+                dst_hdl.seek(copied)
+                try:
+                    while True:
+                        if kernel_copy == "copy_file_range":
+                            count = os.copy_file_range(src_hdl.fileno(), dst_hdl.fileno(), buffer_size,
+                                                       copied, copied)
+                        else:
+                            count = os.sendfile(dst_hdl.fileno(), src_hdl.fileno(), copied, buffer_size)
+                        if count == 0:
+                            return copied
+                        copied += count
+                except OSError as e:
+                    # Not supported between these file systems, go on with the next way
+                    if e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                        raise
+
+        src_hdl.seek(copied)
+        dst_hdl.seek(copied)
+        while True:
+            data = src_hdl.read(buffer_size)
+            if not data:
+                return copied
+            if md5 != None:
+                md5.update(data)
+            dst_hdl.write(data)
+            copied += len(data)
+
+
+def usb_copy(src, dest_tmp, dest):
+    """
+    Copies a file from the USB stick to the bootflash (through dest_tmp). The copy is
+    skipped if the bootflash already has a file with the same size and MD5. When MD5s
+    are required, the MD5 is computed during the copy and stored in the verification
+    cache, so verify_md5() doesn't read the file again.
+    """
+    size = os.path.getsize(src)
+    if os.path.isfile(dest) and os.path.getsize(dest) == size and get_file_md5(dest) == get_file_md5(src):
+        poap_log("%s already has the same size and MD5 as %s, skipping the copy" % (dest, src))
+        return
+
+    start = time.time()
+    buffer_size = options["native_transfer_buffer"] * 1024 * 1024
+    md5 = hashlib.md5() if options["require_md5"] == True else None
+    copy_file_data(src, dest_tmp, buffer_size, md5)
+    elapsed = max(time.time() - start, 0.001)
+    poap_log("Copied %d bytes from USB in %.1fs (%.1f MB/s)" % (size, elapsed, size / elapsed / (1024 * 1024)))
+
+    if os.path.getsize(dest_tmp) != size:
+        remove_file(dest_tmp)
+        abort("Copy of %s is incomplete (bootflash may be full)" % src)
+    os.rename(dest_tmp, dest)
+    poap_log("Renamed %s to %s" % (dest_tmp, dest))
+
+    if md5 != None:
+        record_verified_md5(src, md5.hexdigest())
+        record_verified_md5(dest, md5.hexdigest())
 
-    if ("License" in dictionary):
-        for lic in dictionary["License"]:
-            serial_path = os.path.join(options["install_path"], lic.strip())
 
-            dst = "poap_files/" + lic.split('/')[-1]
+def get_file_md5(filename):
+    """
+    Gets the MD5 of a file from the verification cache, or computes it and caches it
+    """
+    md5 = get_verified_md5(filename)
+    if md5 == None:
+        md5 = compute_md5(filename)
+        record_verified_md5(filename, md5)
+    return md5
+
+
+def sync_file_to_standby(src, dst):
+    """
+    Copies a file to the standby supervisor unless the standby already has it with the
+    same size and MD5. The copy is read back and only kept (and its MD5 cached) if it
+    has the MD5 of the file. Runs in the standby sync thread.
+    """
+    size = os.path.getsize(src)
+    if os.path.isfile(dst) and os.path.getsize(dst) == size and get_file_md5(dst) == get_file_md5(src):
+        standby_sync_stats["skipped"] += 1
+        standby_sync_stats["skipped_bytes"] += size
+        return
+
+    md5 = get_file_md5(src)
+    copy_file_data(src, "%s.tmp" % dst)
+    if compute_md5("%s.tmp" % dst) != md5:
+        remove_file("%s.tmp" % dst)
+        raise IOError("the copy doesn't have the MD5 of %s" % src)
+    os.rename("%s.tmp" % dst, dst)
+    record_verified_md5(dst, md5)
+    standby_sync_stats["copied"] += 1
+    standby_sync_stats["copied_bytes"] += size
+
+
+def run_standby_sync():
+    """
+    Works through the standby sync queue, in order, see queue_standby_sync()
+    """
+    while True:
+        action, src, dst = standby_sync_queue.get()
+        try:
+            if action == "copy":
+                sync_file_to_standby(src, dst)
+            elif os.path.isdir(dst):
+                import shutil
+                shutil.rmtree(dst)
+                standby_sync_stats["removed"] += 1
+            elif os.path.exists(dst):
+                os.remove(dst)
+                standby_sync_stats["removed"] += 1
+        except Exception as e:
+            # Anything else would end the thread, and wait_for_standby_sync() would never return
+            standby_sync_stats["failed"] += 1
+            poap_log("WARN: Failed to %s %s on the standby supervisor: %s" % (action, dst, str(e) or type(e).__name__))
+        finally:
+            standby_sync_queue.task_done()
+
+
+def queue_standby_sync(src, dst=None, action="copy"):
+    """
+    Queues a file copy ("copy") or removal ("remove") on the standby supervisor. The
+    queue is worked through in a background thread while the active supervisor goes
+    on, see wait_for_standby_sync(). dst defaults to the same path on the standby.
+    Nothing is done if the standby directory doesn't exist (no standby supervisor).
+    """
+    global standby_sync_queue, standby_sync_thread
+
+    if dst == None:
+        dst = get_standby_path(src)
+    if not os.path.isdir(os.path.dirname(dst.rstrip("/"))):
+        return
+
+    if standby_sync_thread == None:
+        standby_sync_queue = queue.Queue()
+        standby_sync_thread = threading.Thread(target=run_standby_sync)
+        standby_sync_thread.daemon = True
+        standby_sync_thread.start()
+    standby_sync_queue.put((action, src, dst))
 
-            do_copy(serial_path, dst, timeout, dst, False)
 
-    if ("RPM" in dictionary):
-        rpm_error = False
-        for rpm in dictionary["RPM"]:
-            rpm = rpm.strip()
-            serial_path = os.path.join(options["install_path"], rpm)
+def queue_standby_tree_sync(src):
+    """
+    Queues the copy of a directory tree to the standby supervisor, see queue_standby_sync()
+    """
+    for root, dirs, files in os.walk(src):
+        standby_root = get_standby_path(root)
+        if not os.path.isdir(standby_root) and os.path.isdir(os.path.dirname(standby_root)):
+            os.makedirs(standby_root)
+        for name in files:
+            queue_standby_sync(os.path.join(root, name))
 
-            dst = "poap_files/" + rpm.split('/')[-1]
 
-            do_copy(serial_path, dst, timeout, dst, False)
-        for rpm in dictionary["RPM"]:
-            rpm = rpm.strip()
-            name_str = "rpm -qp --qf '%{NAME}-%{VERSION}-%{RELEASE}.%{ARCH}.rpm' /bootflash/poap_files/"+ rpm.split('/')[-1]
-            orig_name = subprocess.check_output(name_str, shell=True)
-            orig_name = byte2str(orig_name)
-            if (orig_name != rpm.split('/')[-1]):
-                poap_log ("ERROR : RPM file %s does not match RPM package naming convention. Expected name: %s" %(rpm.split('/')[-1],orig_name))
-                rpm_error = True
-        if rpm_error:
-            abort("Please correct the above rpm files in rpm source location and update YAML file accordingly.")
-    if ("Certificate" in dictionary):
-        for cert in dictionary["Certificate"]:
-            cert  = cert.strip()
-            serial_path = os.path.join(options["install_path"], cert)
+def wait_for_standby_sync():
+    """
+    Waits until everything queued for the standby supervisor is done and logs how much
+    was copied versus skipped (because the standby already had it) since the last wait
+    """
+    if standby_sync_queue == None:
+        return
 
-            dst = "poap_files/" + cert.split('/')[-1]
+    standby_sync_queue.join()
+    poap_log("Standby sync: copied %d file(s) (%d bytes), skipped %d unchanged file(s) (%d bytes), "
+             "removed %d, failed %d" % (standby_sync_stats["copied"], standby_sync_stats["copied_bytes"],
+                                        standby_sync_stats["skipped"], standby_sync_stats["skipped_bytes"],
+                                        standby_sync_stats["removed"], standby_sync_stats["failed"]))
+    for key in standby_sync_stats:
+        standby_sync_stats[key] = 0
 
-            do_copy(serial_path, dst, timeout, dst, False)
-    if ("Trustpoint" in dictionary):
-        for ca in dictionary["Trustpoint"].keys():
-            tmp_cmd = "mkdir -p /bootflash/poap_files/" + ca
-            os.system(tmp_cmd)
-            dst = "poap_files/" + ca + "/"
-            for tp_cert, crypto_pass in dictionary["Trustpoint"][ca].items():
-                tp_cert = tp_cert.strip()
-                dst = dst + tp_cert.split('/')[-1]
-                serial_path = os.path.join(options["install_path"], tp_cert)
-                do_copy(serial_path, dst, timeout, dst, False)
 
-   
-def install_license():
+def get_rpm_repo_type(rpm_info):
     """
-    Installs the license files.
+    Gets which repository (see RPM_REPOS) an RPM is installed into
     """
+    if len(rpm_info["group"]) != 0 and 'Patch-RPM' in rpm_info["group"]:
+        return "patch"
+    elif len(rpm_info["nxos_rpm_type"]) != 0 and 'feature' in rpm_info["nxos_rpm_type"]:
+        return "feature"
+    return "thirdparty"
 
-    conf_file_second = os.path.join("/bootflash", options["split_config_second"])
-    tmp_file_second = conf_file_second + ".tmp"
-    tmp_file_write = open(tmp_file_second, 'w')
-    for file in os.listdir("/bootflash/poap_files"):
-        if file.endswith(".lic"):
-            poap_log("Installing license file: %s" % file)
-            conf_file_second = os.path.join("/bootflash", options["split_config_second"])
-            tmp_file_second = conf_file_second + ".tmp"
-
-            tmp_file_write.write("install license bootflash:poap_files/%s\n" % file)
-            poap_log("Installed license succesfully.")
-    tmp_file_write.close()
-    with open(conf_file_second, 'r') as read_file, open (tmp_file_second, 'a+') as write_file:
-        write_file.write(read_file.read())
-    os.rename(tmp_file_second, conf_file_second)
-
-    poap_log("Installed all licenses succesfully.")
 
-            
-def check_if_rpm_in_file(file_name, rpm):
+def refresh_rpm_repos(repos):
     """
-    Check if any line in the file contains given rpm
+    Regenerates the metadata of the given RPM repositories. Each repository is
+    refreshed only once, and the active and standby supervisors are refreshed
+    at the same time.
     """
-    if(not(os.path.exists(file_name))):
-        return True
-    with open(file_name, 'r') as read_obj:
-        for line in read_obj:
-            if rpm in line:
-                return True
-    return False
+    if len(repos) == 0:
+        return
+
+    get_nxos_version()
+    image_parts = [part for part in re.split(r"[\.()]", nxos_version) if part]
+
+    commands = []
+    for repo in sorted(repos):
+        for path in [repo, get_standby_path(repo)]:
+            if not os.path.isdir(path):
+                continue
+            if int(image_parts[0]) >= 10:
+                commands.append(["sudo", "/usr/bin/createrepo_c", "--update", path])
+            else:
+                commands.append(["sudo", "/usr/bin/python", "/usr/share/createrepo/genpkgmetadata.py", "--update", path])
+
+    poap_log("Refreshing metadata of RPM repositories: %s" % ", ".join(sorted(repos)))
+    sp = import_subprocess()
+    if sp == None:
+        for command in commands:
+            os.system(" ".join(command))
+        return
+
+    processes = [sp.Popen(command) for command in commands]
+    for command, process in zip(commands, processes):
+        if process.wait() != 0:
+            poap_log("WARN: %s failed with return code %d" % (" ".join(command), process.returncode))
 
 
 def install_rpm():
     """
-    Installs the rpms for next reload
+    Installs the rpms for next reload. All RPMs are staged into their repositories
+    first, then the metadata of every repository that changed is refreshed once.
+    Each change is written to the rollback journal before it is done.
     """
     
     patch_count = 0
     activate_list = "committed_list = "
-    version = get_nxos_version()
-    image_parts = [part for part in re.split("[\.()]", version) if part]
+    touched_repos = set()
     for file in os.listdir("/bootflash/poap_files"):
         if file.endswith(".rpm"):
             poap_log("Installing rpm file: %s" % file)
-            os.system('echo "' + file + '" >> /bootflash/poap_files/success_install_list')
-            group_string = "/usr/bin/rpm -qp --qf %{GROUP} /bootflash/poap_files/" + file
-            rpm_string = "/usr/bin/rpm -qp --queryformat %{NXOSRPMTYPE} /bootflash/poap_files/" + file
-            rpmgrp = subprocess.check_output(group_string, shell=True)
-            rpmtype = subprocess.check_output(rpm_string, shell=True)
-            if (len(rpmgrp) != 0 and 'Patch-RPM' in str(rpmgrp)):
+            rpm_info = get_rpm_metadata(file)
+            repo_type = get_rpm_repo_type(rpm_info)
+            repo = RPM_REPOS[repo_type]
+            if repo_type == "patch":
                 patch_rpm_name = file.replace(".rpm", "")
                 if(not check_if_rpm_in_file("/bootflash/.rpmstore/patching/patchrepo/meta/patching_meta.inf", patch_rpm_name)):
                     poap_log("RPM is a patch RPM. executing clis for the same.")
-                    os.system("cp /bootflash/poap_files/%s /bootflash/.rpmstore/patching/patchrepo/" % file)
-                    os.system("cp /bootflash/poap_files/%s /bootflash_sup-remote/.rpmstore/patching/patchrepo/" % file)
-                    if(int(image_parts[0]) >= 10):
-                        os.system("sudo /usr/bin/createrepo_c --update /bootflash/.rpmstore/patching/patchrepo/")
-                        os.system("sudo /usr/bin/createrepo_c --update /bootflash_sup-remote/.rpmstore/patching/patchrepo/")
-                    else:
-                        os.system("sudo /usr/bin/python /usr/share/createrepo/genpkgmetadata.py --update /bootflash/.rpmstore/patching/patchrepo/")
-                        os.system("sudo /usr/bin/python /usr/share/createrepo/genpkgmetadata.py --update /bootflash_sup-remote/.rpmstore/patching/patchrepo/")
+                    write_rollback_journal({"action": "copy_rpm", "file": file, "repo": repo})
+                    os.system("cp /bootflash/poap_files/%s %s" % (file, repo))
+                    queue_standby_sync("/bootflash/poap_files/%s" % file, get_standby_path(os.path.join(repo, file)))
+                    touched_repos.add(repo)
                     patch_count = patch_count + 1
                     activate_list  = activate_list + file.replace(".rpm", " ")
             else:
-                if (len(rpmtype) != 0 and 'feature' in str(rpmtype)):
+                if repo_type == "feature":
                     poap_log("RPM is a nxos RPM. executing clis for the same.")
-                    os.system("cp /bootflash/poap_files/%s /bootflash/.rpmstore/patching/localrepo/" % file)
-                    os.system("cp /bootflash/poap_files/%s /bootflash_sup-remote/.rpmstore/patching/localrepo/" % file)
-                    if(int(image_parts[0]) >= 10):
-                        os.system("sudo /usr/bin/createrepo_c --update /bootflash/.rpmstore/patching/localrepo/")
-                        os.system("sudo /usr/bin/createrepo_c --update /bootflash_sup-remote/.rpmstore/patching/localrepo/")
-                    else:                
-                        os.system("sudo /usr/bin/python /usr/share/createrepo/genpkgmetadata.py /bootflash/.rpmstore/patching/localrepo/")
-                        os.system("sudo /usr/bin/python /usr/share/createrepo/genpkgmetadata.py /bootflash_sup-remote/.rpmstore/patching/localrepo/")
                 else:
                     poap_log("RPM is a third-party RPM. Executing clis for the same")
-                    os.system("cp /bootflash/poap_files/%s /bootflash/.rpmstore/thirdparty/" % file)      
-                    os.system("cp /bootflash/poap_files/%s /bootflash_sup-remote/.rpmstore/thirdparty/" % file)
-                    if(int(image_parts[0]) >= 10):
-                        os.system("sudo /usr/bin/createrepo_c --update /bootflash/.rpmstore/thirdparty/")
-                        os.system("sudo /usr/bin/createrepo_c --update /bootflash_sup-remote/.rpmstore/thirdparty/")      
-                    else:
-                        os.system("sudo /usr/bin/python /usr/share/createrepo/genpkgmetadata.py /bootflash/.rpmstore/thirdparty/")
-                        os.system("sudo /usr/bin/python /usr/share/createrepo/genpkgmetadata.py /bootflash_sup-remote/.rpmstore/thirdparty/")
-                rpm_name = subprocess.check_output("/usr/bin/rpm -qp --qf %%{NAME} /bootflash/poap_files/%s" %file, shell=True)
-                rpm_name = byte2str(rpm_name)
+                write_rollback_journal({"action": "copy_rpm", "file": file, "repo": repo})
+                os.system("cp /bootflash/poap_files/%s %s" % (file, repo))
+                queue_standby_sync("/bootflash/poap_files/%s" % file, get_standby_path(os.path.join(repo, file)))
+                touched_repos.add(repo)
+                rpm_name = rpm_info["name"]
                 if not check_if_rpm_in_file("/bootflash/.rpmstore/nxos_rpms_persisted", rpm_name):
-                    rpm_append_str = "/usr/bin/rpm -qp --qf %{NAME} /bootflash/poap_files/" + file + " >> /bootflash/.rpmstore/nxos_rpms_persisted"
-                    os.system(rpm_append_str)
-                    os.system('echo "" >> /bootflash/.rpmstore/nxos_rpms_persisted')
-                    standby_append_str = "/usr/bin/rpm -qp --qf %{NAME} /bootflash/poap_files/" + file + " >> /bootflash_sup-remote/.rpmstore/nxos_rpms_persisted"
-                    os.system(standby_append_str)
-                    os.system('echo "" >> /bootflash_sup-remote/.rpmstore/nxos_rpms_persisted')
+                    write_rollback_journal({"action": "persist", "name": rpm_name})
+                    os.system('echo "%s" >> /bootflash/.rpmstore/nxos_rpms_persisted' % rpm_name)
+                    os.system('echo "%s" >> /bootflash_sup-remote/.rpmstore/nxos_rpms_persisted' % rpm_name)
             poap_log("RPM %s scheduled to be installed on next reload. " % file)
+    # The standby repositories need their RPMs before their metadata is refreshed
+    wait_for_standby_sync()
+    refresh_rpm_repos(touched_repos)
     if (patch_count > 0):
+        write_rollback_journal({"action": "patch_meta", "entries": activate_list.replace("committed_list = ", "").split()})
         if((os.path.exists("/bootflash/.rpmstore/patching/patchrepo/meta/patching_meta.inf"))):
-            fp = open("/bootflash/.rpmstore/patching/patchrepo/meta/patching_meta.inf", 'r')
-            patching_meta = fp.readlines()
-            patching_meta = ''.join(patching_meta)
-            if("committed_list" in patching_meta):
+            if(check_if_rpm_in_file("/bootflash/.rpmstore/patching/patchrepo/meta/patching_meta.inf", "committed_list")):
                 activate_list = activate_list.replace("committed_list = ", "")
                 patch_append_str = 'sed -i "/committed_list/ s/$/ {0}/" /bootflash/.rpmstore/patching/patchrepo/meta/patching_meta.inf'.format(activate_list)
                 standby_append_str = 'sed -i "/committed_list/ s/$/ {0}/" /bootflash_sup-remote/.rpmstore/patching/patchrepo/meta/patching_meta.inf'.format(activate_list)
                 os.system(patch_append_str)
                 os.system(standby_append_str)
-            elif("[patching]" in patching_meta):
+            elif(check_if_rpm_in_file("/bootflash/.rpmstore/patching/patchrepo/meta/patching_meta.inf", "[patching]")):
                 patch_append_str = 'echo "' + activate_list + '" >> /bootflash/.rpmstore/patching/patchrepo/meta/patching_meta.inf'
                 standby_append_str = 'echo "' + activate_list + '" >> /bootflash_sup-remote/.rpmstore/patching/patchrepo/meta/patching_meta.inf'
                 os.system(patch_append_str)
@@ -1720,8 +3708,7 @@ def install_certificate():
     """
     Installs the certificate files.
     """
-    stream = open("/bootflash/poap_device_recipe.yaml", 'r')
-    dictionary = yaml.load(stream)
+    dictionary = load_device_recipe()
     config_file_second = open(os.path.join("/bootflash", options["split_config_second"]), "a+")
     
     if ("Trustpoint" in dictionary):
@@ -1741,19 +3728,129 @@ def install_certificate():
             
 def copy_standby_files():
     """
-    Checks if the standby module is present and copies the
-    poap_files folder to standby bootflash.
+    Checks if the standby module is present and syncs the
+    poap_files folder to standby bootflash. Only missing or changed
+    files are copied. The copy goes on in the background while the
+    active supervisor works, wait_for_standby_sync() waits for it
+    (install_rpm() does before it refreshes the repositories).
     """
     standby = cli("show module | grep ha-standby")
     if(len(standby) > 0):
-        os.system("cp -rf /bootflash/poap_files /bootflash_sup-remote/")
+        queue_standby_tree_sync("/bootflash/poap_files")
 
                 
+def get_boot_variable_images():
+    """
+    Gets the names of the images referenced by the boot variables
+    """
+    try:
+        boot_output = cli("show boot")
+        if legacy:
+            boot_output = boot_output[1]
+    except Exception as e:
+        poap_log("WARN: Unable to get boot variables: %s" % str(e))
+        return None
+
+    return set(os.path.basename(image) for image in re.findall(r"bootflash:/*(\S+)", boot_output))
+
+
+def get_planned_downloads():
+    """
+    Lists the files this run will download as (server path, destination, fallback size)
+    tuples. The fallback size (in bytes) is planned for files whose size is unknown.
+    """
+    planned = []
+    if options["upgrade_system_image"]:
+        planned.append((os.path.join(options["upgrade_image_path"], options["upgrade_system_image"]),
+                        os.path.join(options["destination_path"], options["upgrade_system_image"]),
+                        options["required_space"] * 1024 * 1024))
+    if options["copy_config"] == True:
+        planned.append((os.path.join(options["config_path"], options["source_config_file"]),
+                        os.path.join(options["destination_path"], options["destination_config"]),
+                        1024 * 1024))
+
+    if options["install_path"] and os.path.exists(RECIPE_FILE):
+        dictionary = load_device_recipe()
+        for key in ["License", "RPM", "Certificate"]:
+            for artifact in dictionary.get(key, None) or []:
+                planned.append((os.path.join(options["install_path"], artifact.strip()),
+                                os.path.join("/bootflash/poap_files", artifact.strip().split('/')[-1]),
+                                1024 * 1024))
+        for ca, certs in (dictionary.get("Trustpoint", None) or {}).items():
+            for tp_cert in certs.keys():
+                planned.append((os.path.join(options["install_path"], tp_cert.strip()),
+                                os.path.join("/bootflash/poap_files", ca, tp_cert.strip().split('/')[-1]),
+                                1024 * 1024))
+    return planned
+
+
+def plan_required_space():
+    """
+    Computes the bootflash space in bytes this run needs, from the size of every file
+    it will download. Files that are already on the bootflash with the expected size
+    don't need space. If the size of the system image is unknown, "required_space"
+    is planned for it instead.
+    """
+    required_bytes = options["space_margin"] * 1024 * 1024
+
+    for source, dest, fallback_size in get_planned_downloads():
+        size = get_remote_file_size(source)
+        if size == None:
+            poap_log("Size of %s is unknown, planning for %d MB" % (source, fallback_size / (1024 * 1024)))
+            size = fallback_size
+        elif os.path.exists(dest) and os.path.getsize(dest) == size:
+            poap_log("%s is already on the bootflash" % dest)
+            continue
+        else:
+            poap_log("Size of %s is %d bytes" % (source, size))
+        required_bytes += size
+
+    return required_bytes
+
+
+def get_eviction_candidates():
+    """
+    Lists the files that can be deleted to free bootflash space, least recently used
+    first: NX-OS images that are neither running nor in the boot variables (nor the
+    image we are about to install), stale .tmp files and old POAP logs.
+    """
+    import glob
+
+    protected = set([nxos_filename, options["upgrade_system_image"]])
+    protected.update(os.path.basename(image) for image in extracted_images)
+    boot_images = get_boot_variable_images()
+    if boot_images == None:
+        # Without the boot variables we can't know which images are safe to delete
+        image_list = []
+    else:
+        protected.update(boot_images)
+        image_list = glob.glob("/bootflash/nxos*.bin")
+
+    candidates = [image for image in image_list if os.path.basename(image) not in protected]
+    candidates += glob.glob("/bootflash/*.tmp")
+    candidates += glob.glob("/bootflash/*poap*script.log.gz")
+
+    def last_used(filename):
+        stats = os.stat(filename)
+        return max(stats.st_atime, stats.st_mtime)
+
+    return sorted([candidate for candidate in candidates if os.path.isfile(candidate)], key=last_used)
+
+
+def get_free_space():
+    """
+    Gets the free space on the bootflash in bytes
+    """
+    bootflash_stats = os.statvfs("/bootflash/")
+    return bootflash_stats.f_bsize * bootflash_stats.f_bavail
+
+
 def verify_storage_capacity():
     """
-    Collects bootflash storage information and aborts the script if
-    there is not enough free space to satisfy the "required_space"
-    parameter in the options list.
+    Collects bootflash storage information and compares the free space with the space
+    this run needs (see plan_required_space()). If there isn't enough free space, stale
+    files are evicted (see get_eviction_candidates()) until there is. Aborts the script
+    if that still isn't enough.
     """
 
     global options
@@ -1772,13 +3869,24 @@ def verify_storage_capacity():
     used_space_megabytes = total_capacity_megabytes - free_space_megabytes
     used_space_megabytes_formatted = f"{used_space_megabytes:,.2f} MB"
 
-    required_space_in_megabytes_formatted = f"{options['required_space']:,.2f} MB"
-
     poap_log("Bootflash total capacity: %s" % total_capacity_megabytes_formatted)
     poap_log("Bootflash used space: %s" % used_space_megabytes_formatted)
     poap_log("Bootflash free space: %s" % free_space_megabytes_formatted)
 
-    if options["required_space"] >= free_space_megabytes:
+    required_space_megabytes = plan_required_space() / (1024 * 1024)
+    required_space_in_megabytes_formatted = f"{required_space_megabytes:,.2f} MB"
+    poap_log("Bootflash space needed by this run: %s" % required_space_in_megabytes_formatted)
+
+    if required_space_megabytes >= free_space_megabytes and options["evict_stale_files"] == True:
+        poap_log("Not enough free space, removing stale files from the bootflash")
+        for candidate in get_eviction_candidates():
+            remove_file(candidate)
+            free_space_megabytes = get_free_space() / (1024 * 1024)
+            if required_space_megabytes < free_space_megabytes:
+                break
+        poap_log("Bootflash free space: %s" % f"{free_space_megabytes:,.2f} MB")
+
+    if required_space_megabytes >= free_space_megabytes:
         abort("Exiting script. Bootflash free space does not meet the requirement of: %s" % required_space_in_megabytes_formatted)
     else:
         poap_log("Bootflash required space of %s has been satisfied" % required_space_in_megabytes_formatted)
@@ -1846,12 +3954,10 @@ def set_cfg_file_host():
     poap_log("Selected conf file name : %s" % options["source_config_file"])
 
 
-def set_cfg_file_location():
+def get_cdp_neighbor():
     """
-    Sets the name of the switch config file to download based on cdp
-    information. e.g conf_switch_Eth1_32.cfg
+    Gets the name and the interface of the CDP neighbor on the POAP interface
     """
-    poap_log("Setting source cfg filename")
     poap_log("show cdp neighbors interface %s" % os.environ['POAP_INTF'])
     cdp_output = cli("show cdp neighbors interface %s" % os.environ['POAP_INTF'])
 
@@ -1897,11 +4003,128 @@ def set_cfg_file_location():
         # 3K 6x and older releases don't print this info
         intf_name = cdp_info[-1]
 
+    return switch_name, intf_name
+
+
+def short_intf_name(intf_name):
+    """
+    Shortens an interface name the way the CDP neighbor table prints it (Ethernet1/32 -> Eth1/32)
+    """
+    return re.sub("^Ethernet", "Eth", intf_name.strip())
+
+
+def get_table_rows(output, table, row):
+    """
+    Gets the rows of a table of a "| json" show command. Single rows are not in a list.
+    """
+    rows = output.get(table, {}).get(row, [])
+    if isinstance(rows, dict):
+        rows = [rows]
+    return rows
+
+
+def get_neighbor_table():
+    """
+    Gets the CDP and LLDP neighbors of all the interfaces of the switch as a list of
+    (local interface, neighbor name, neighbor interface). The neighbors of the POAP
+    interface come first. The table is read once per run from the structured output of
+    "show cdp neighbors detail | json" and "show lldp neighbors detail | json".
+    """
+    global neighbor_table
+
+    if neighbor_table != None:
+        return neighbor_table
+
+    neighbors = []
+    if not legacy:
+        try:
+            cdp_output = json.loads(cli("show cdp neighbors detail | json") or "{}")
+            for entry in get_table_rows(cdp_output, "TABLE_cdp_neighbor_detail_info", "ROW_cdp_neighbor_detail_info"):
+                # The device ID is followed by the serial number in parentheses on NX-OS
+                neighbors.append((entry.get("intf_id", ""), entry.get("device_id", "").split("(")[0],
+                                  entry.get("port_id", "")))
+        except Exception as e:
+            poap_log("Unable to read the CDP neighbors: %s" % str(e))
+
+        try:
+            lldp_output = json.loads(cli("show lldp neighbors detail | json") or "{}")
+            for entry in get_table_rows(lldp_output, "TABLE_nbor_detail", "ROW_nbor_detail"):
+                neighbors.append((entry.get("l_port_id", ""), entry.get("sys_name", ""), entry.get("port_id", "")))
+        except Exception as e:
+            poap_log("Unable to read the LLDP neighbors: %s" % str(e))
+
+    poap_intf = short_intf_name(os.environ.get('POAP_INTF', ""))
+    neighbor_table = []
+    for local_intf, switch_name, intf_name in neighbors:
+        if switch_name == "" or intf_name == "":
+            continue
+        neighbor = (short_intf_name(local_intf), switch_name, short_intf_name(intf_name))
+        if neighbor not in neighbor_table:
+            neighbor_table.append(neighbor)
+    neighbor_table.sort(key=lambda neighbor: neighbor[0] != poap_intf)
+
+    for local_intf, switch_name, intf_name in neighbor_table:
+        poap_log("Neighbor on %s: %s %s" % (local_intf, switch_name, intf_name))
+    return neighbor_table
+
+
+def get_neighbor_locations():
+    """
+    Gets the location names (e.g. switch_Eth1_32) of all the neighbors, the ones on the
+    POAP interface first. Neighbor interfaces are given both short and long.
+    """
+    locations = []
+    for _, switch_name, intf_name in get_neighbor_table():
+        for name in [intf_name, re.sub("^Eth(?=\d)", "Ethernet", intf_name)]:
+            location = ("%s_%s" % (switch_name, name)).replace("/", "_")
+            if location not in locations:
+                locations.append(location)
+    return locations
+
+
+def set_cfg_file_location():
+    """
+    Sets the name of the switch config file to download based on cdp
+    information. e.g conf_switch_Eth1_32.cfg
+    """
+    poap_log("Setting source cfg filename")
+    poap_intf = short_intf_name(os.environ['POAP_INTF'])
+    neighbors = [n for n in get_neighbor_table() if n[0] == poap_intf]
+    if len(neighbors) > 0:
+        _, switch_name, intf_name = neighbors[0]
+    else:
+        # Releases without structured output
+        switch_name, intf_name = get_cdp_neighbor()
     options["source_config_file"] = "conf_%s_%s.cfg" % (switch_name, intf_name)
     options["source_config_file"] = options["source_config_file"].replace("/", "_")
     poap_log("Selected conf file name : %s" % options["source_config_file"])
 
 
+def get_show_version():
+    """
+    Runs "show version" once per run and returns its output. All the version, date and
+    image information of the switch is read from it.
+    """
+    global show_version_output
+
+    if show_version_output == None:
+        output = cli("show version")
+        if legacy:
+            output = output[1]
+        show_version_output = output
+    return show_version_output
+
+
+def get_show_version_line(text):
+    """
+    Gets the first line of "show version" that contains the text, without the newline
+    """
+    for line in get_show_version().split("\n"):
+        if text in line:
+            return line.strip("\n")
+    raise ValueError("\"%s\" not found in show version" % text)
+
+
 def get_nxos_version(option=0):
     """
     Gets the image version of the switch from CLI using "show version" and then filtering the output.     
@@ -1910,8 +4133,7 @@ def get_nxos_version(option=0):
     global nxos_version
 
     try:
-        nxos_version = cli("show version | i 'NXOS: version' | head lines 1 | sed 's/.*version //'")
-        nxos_version = nxos_version.strip('\n')
+        nxos_version = get_show_version_line("NXOS: version").split("version ", 1)[1]
         poap_log("System NX-OS version: " + nxos_version)
     except Exception as e:
         poap_log("Unable to detect system NX-OS version!")
@@ -1925,8 +4147,7 @@ def get_nxos_date():
     global nxos_date
 
     try:
-        nxos_date = cli("show version | i 'NXOS compile time: '")
-        nxos_date = nxos_date.strip('\n')
+        nxos_date = get_show_version_line("NXOS compile time: ")
         nxos_date = nxos_date.split(" ")
         poap_log("System NX-OS version date: " + nxos_date[6])
     except Exception as e:
@@ -1942,8 +4163,7 @@ def get_bios_version():
     global bios_version
 
     try:
-        bios_version = cli("show version | i 'BIOS: version' | sed 's/.*version //'")
-        bios_version = bios_version.strip('\n')
+        bios_version = get_show_version_line("BIOS: version").split("version ", 1)[1]
         poap_log("System BIOS version: " + bios_version)
     except Exception as e:
         poap_log("Unable to detect system BIOS version!")
@@ -2085,8 +4305,7 @@ def get_currently_booted_image_filename():
     global nxos_filename
 
     try:
-        nxos_filename = cli("show version | i 'NXOS image file' | tr '///' '\n' | sed -n '4p'")
-        nxos_filename = nxos_filename.strip('\n')
+        nxos_filename = get_show_version_line("NXOS image file").split("/")[3]
         poap_log("Currently booted filename is: " + nxos_filename)
     except Exception as e:
         poap_log("Unable to detect currently booted NX-OS filename!")
@@ -2171,10 +4390,15 @@ def download_personality_tarball():
 
     tarball_path = os.path.join(options["personality_path"], options["source_tarball"])
     tmp_file = "%s.tmp" % options["destination_tarball"]
-    do_copy(tarball_path, options["destination_tarball"],
-            options["timeout_copy_personality"], tmp_file)
+    if (options["native_transfer"] == True and options["transfer_protocol"] in ["http", "https"]
+            and os.environ.get("POAP_PHASE", None) != "USB"):
+        stream_personality_tarball(tarball_path, tmp_file, md5_sum_given)
+    else:
+        do_copy(tarball_path, options["destination_tarball"],
+                options["timeout_copy_personality"], tmp_file)
 
-    if options["require_md5"] == True and md5_sum_given:
+    if options["require_md5"] == True and md5_sum_given and get_verified_md5(
+            os.path.join(options["destination_path"], options["destination_tarball"])) != md5_sum_given:
         if not verify_md5(md5_sum_given, os.path.join(options["destination_path"],
                                                       options["destination_tarball"])):
             abort("#### Tar file %s MD5 verification failed #####\n" %
@@ -2185,25 +4409,101 @@ def download_personality_tarball():
                           options["destination_tarball"]))
 
 
+def parse_tar_header(block):
+    """
+    Parses a 512 byte tar header block. Returns (name, size, type) or None for the
+    zero blocks that end the archive.
+    """
+    if block.count(b"\x00") == len(block):
+        return None
+
+    name = block[0:100].split(b"\x00", 1)[0]
+    # ustar archives keep long paths in a separate prefix field
+    if block[257:262] == b"ustar":
+        prefix = block[345:500].split(b"\x00", 1)[0]
+        if prefix:
+            name = prefix + b"/" + name
+
+    size_field = block[124:136]
+    if size_field[0:1] == b"\x80":
+        # GNU base-256 encoding for members of 8 GB or more
+        size = int.from_bytes(size_field[1:], "big")
+    else:
+        size = int(size_field.split(b"\x00", 1)[0].strip() or b"0", 8)
+
+    return byte2str(name), size, block[156:157]
+
+
+def get_image_from_tar_member(name, read_data):
+    """
+    Checks if a tarball member names the system image. read_data() returns the content
+    of the member. Returns the system image name or None.
+    """
+    # Legacy personality support
+    match = re.search("IMAGEFILE_(.+)", name)
+    if match:
+        return byte2str(match.group(1))
+    # File container way
+    elif os.path.basename(name) == "IMAGEFILE":
+        return byte2str(read_data().strip())
+    return None
+
+
+def scan_tarball_for_image(tarball_path):
+    """
+    Walks the headers of the tarball in order and stops at the first IMAGEFILE or
+    IMAGEFILE_<image> member, skipping over the data of all the other members.
+    Returns the system image name or None.
+    """
+    with open(tarball_path, "rb") as tar_hdl:
+        long_name = None
+        while True:
+            header = parse_tar_header(tar_hdl.read(512))
+            if header == None:
+                return None
+            name, size, member_type = header
+            data_start = tar_hdl.tell()
+            padded_size = (size + 511) // 512 * 512
+
+            if member_type == b"L":
+                # GNU long name of the next member
+                long_name = byte2str(tar_hdl.read(size).split(b"\x00", 1)[0])
+            elif member_type == b"x":
+                # pax extended header, may hold the path of the next member
+                match = re.search(r"\d+ path=([^\n]*)\n", byte2str(tar_hdl.read(size)))
+                long_name = match.group(1) if match else None
+            elif member_type != b"g":
+                if long_name != None:
+                    name = long_name
+                    long_name = None
+                image = get_image_from_tar_member(name, lambda: tar_hdl.read(size))
+                if image != None:
+                    return image
+
+            tar_hdl.seek(data_start + padded_size)
+
+
 def get_system_image_from_tarball():
     """
-    Extracts the system image name from the tarball
+    Extracts the system image name from the tarball. The result is cached on the
+    bootflash with the MD5 of the tarball, so the tarball is only scanned once.
     """
     global options
 
     tarball_path = os.path.join(options["destination_path"], options["destination_tarball"])
 
-    tar = tarfile.open(tarball_path)
+    stats = os.stat(tarball_path)
+    digest = get_verified_md5(tarball_path) or "%d-%d" % (stats.st_size, stats.st_mtime)
+    cache = read_poap_cache("personality_image")
 
-    file_list = tar.getnames()
-    for file_name in file_list:
-        # Legacy personality support
-        match = re.search("IMAGEFILE_(.+)", file_name)
-        if match:
-            options["target_system_image"] = byte2str(match.group(1))
-        # File container way
-        elif os.path.basename(file_name) == "IMAGEFILE":
-            options["target_system_image"] = byte2str(tar.extractfile(file_name).read().strip())
+    if digest in cache:
+        options["target_system_image"] = cache[digest]
+        poap_log("Using cached system image name for tarball %s" % digest)
+    else:
+        image = scan_tarball_for_image(tarball_path)
+        if image != None:
+            options["target_system_image"] = image
+            write_poap_cache("personality_image", {digest: image})
 
     if options.get("target_system_image") == None:
         abort("Failed to find system image filename from tarball")
@@ -2211,6 +4511,182 @@ def get_system_image_from_tarball():
     poap_log("Using %s as the system image" % options["target_system_image"])
 
 
+class TarStreamParser(object):
+    """
+    Parses a tarball as it is downloaded, one chunk at a time (see feed()). Small
+    metadata members (IMAGEFILE, GNU long names, pax headers) are kept in memory and,
+    with extract, system images (*.bin) are written straight to the bootflash, as .tmp
+    files until the MD5 of the stream is verified (see commit()). Images already on the
+    bootflash aren't overwritten. Everything else is skipped. After the stream ends,
+    "image" holds the system image name (or None) and, once committed, "extracted" the
+    paths of the files written.
+    """
+    def __init__(self, extract_path, extract=True):
+        self.extract_path = extract_path
+        self.extract = extract
+        self.header = b""
+        self.remaining = 0
+        self.padding = 0
+        self.done = False
+        self.long_name = None
+        self.image = None
+        self.extracted = []
+        self.pending = []
+        self.member = None
+
+    def feed(self, data):
+        view = memoryview(data)
+        position = 0
+        while position < len(view) and not self.done:
+            if self.remaining > 0:
+                count = min(self.remaining, len(view) - position)
+                self.consume(view[position:position + count])
+                position += count
+                self.remaining -= count
+                if self.remaining == 0:
+                    self.finish_member()
+            elif self.padding > 0:
+                count = min(self.padding, len(view) - position)
+                position += count
+                self.padding -= count
+            else:
+                count = min(512 - len(self.header), len(view) - position)
+                self.header += bytes(view[position:position + count])
+                position += count
+                if len(self.header) == 512:
+                    self.start_member(self.header)
+                    self.header = b""
+
+    def start_member(self, block):
+        header = parse_tar_header(block)
+        if header == None:
+            self.done = True
+            return
+
+        name, size, member_type = header
+        if member_type not in [b"L", b"x", b"g"] and self.long_name != None:
+            name = self.long_name
+            self.long_name = None
+
+        self.member = {"name": name, "type": member_type, "data": None, "file": None}
+        if member_type in [b"L", b"x"] or (self.image == None and os.path.basename(name) == "IMAGEFILE"):
+            self.member["data"] = []
+        elif self.image == None and re.match("IMAGEFILE_", os.path.basename(name)):
+            # Legacy personality, the member name holds the image name
+            self.image = get_image_from_tar_member(name, None)
+        elif self.extract and member_type in [b"0", b"\x00"] and name.endswith(".bin"):
+            path = os.path.join(self.extract_path, os.path.basename(name))
+            if os.path.exists(path):
+                poap_log("%s is already on the bootflash, not extracting %s from the tarball" % (path, name))
+            else:
+                poap_log("Extracting %s from the tarball to %s" % (name, path))
+                self.member["path"] = path
+                self.member["file"] = open("%s.tmp" % path, "wb")
+
+        self.remaining = size
+        self.padding = (512 - size % 512) % 512
+        if size == 0:
+            self.finish_member()
+
+    def consume(self, data):
+        if self.member["data"] != None:
+            self.member["data"].append(bytes(data))
+        elif self.member["file"] != None:
+            self.member["file"].write(data)
+
+    def finish_member(self):
+        member = self.member
+        data = b"".join(member["data"]) if member["data"] != None else b""
+        if member["type"] == b"L":
+            self.long_name = byte2str(data.split(b"\x00", 1)[0])
+        elif member["type"] == b"x":
+            match = re.search(r"\d+ path=([^\n]*)\n", byte2str(data))
+            self.long_name = match.group(1) if match else None
+        elif member["file"] != None:
+            member["file"].close()
+            self.pending.append(member["path"])
+        elif member["data"] != None:
+            self.image = get_image_from_tar_member(member["name"], lambda: data)
+
+    def close(self, discard=False):
+        """
+        Ends the stream. With discard (the download failed or its MD5 doesn't match),
+        the files extracted from it are removed.
+        """
+        if self.member != None and self.member["file"] != None and not self.member["file"].closed:
+            # The stream ended in the middle of this member
+            self.member["file"].close()
+            remove_file("%s.tmp" % self.member["path"])
+        if discard:
+            for path in self.pending:
+                remove_file("%s.tmp" % path)
+            self.pending = []
+
+    def commit(self):
+        """
+        Moves the files extracted from a verified stream to their final paths
+        """
+        for path in self.pending:
+            os.rename("%s.tmp" % path, path)
+            self.extracted.append(path)
+            # Removed by cleanup_files() if the script aborts
+            extracted_images.append(path)
+        self.pending = []
+
+
+def stream_personality_tarball(tarball_path, tmp_file, md5_sum_given=None):
+    """
+    Downloads the personality tarball with a native transfer and processes it while
+    it downloads: the MD5 is computed on the fly, the system image name is read from
+    IMAGEFILE and system images in the tarball are written straight to the bootflash.
+    The tarball itself is kept for "personality restore", but never read back.
+    """
+    destination = os.path.join(options["destination_path"], options["destination_tarball"])
+    dest_tmp = os.path.join(options["destination_path"], tmp_file)
+    md5 = hashlib.md5()
+
+    # The tarball and the images extracted from it (at most its size) are on the bootflash together
+    size = get_remote_file_size(tarball_path)
+    if size == None:
+        poap_log("Size of %s is unknown, its system images won't be extracted" % tarball_path)
+        extract = False
+    else:
+        required = 2 * size + options["space_margin"] * 1024 * 1024
+        extract = get_free_space() > required
+        if not extract:
+            poap_log("The bootflash can't hold %s and its system images (%d MB), they won't be extracted" % (
+                tarball_path, required / (1024 * 1024)))
+    parser = TarStreamParser(options["destination_path"], extract)
+
+    def on_data(data):
+        md5.update(data)
+        parser.feed(data)
+
+    poap_log("Streaming personality tarball %s" % tarball_path)
+    try:
+        native_download(tarball_path, dest_tmp, None, options["timeout_copy_personality"], on_data=on_data)
+    except BaseException:
+        parser.close(True)
+        raise
+    parser.close()
+
+    md5_calculated = md5.hexdigest()
+    if md5_sum_given and md5_sum_given != md5_calculated:
+        remove_file(dest_tmp)
+        parser.close(True)
+        abort("#### Tar file %s MD5 verification failed #####\n" % destination)
+
+    # Only now the images extracted from the tarball get their real names
+    parser.commit()
+    os.rename(dest_tmp, destination)
+    record_verified_md5(destination, md5_calculated)
+    poap_log("Personality tarball MD5: %s, extracted %d file(s)" % (md5_calculated, len(parser.extracted)))
+
+    if parser.image != None:
+        # Lets get_system_image_from_tarball() skip the scan of the tarball
+        write_poap_cache("personality_image", {md5_calculated: parser.image})
+
+
 def override_options_for_personality():
     """
     Overrides the existing options with the personality specific ones
@@ -2231,11 +4707,106 @@ def initialize_personality():
     override_options_for_personality()
 
 
+def load_config_index():
+    """
+    Downloads the config lookup index ("config_index") once per run. The index maps the
+    identifiers of a switch to its configuration file (relative to "config_path") and
+    its MD5, per identifier type:
+        {"version": 1,
+         "serial_number": {"SAL1911B05K": {"path": "conf.SAL1911B05K", "md5": "..."}},
+         "mac": {"7426CC5C9180": {...}}, "hostname": {"leaf1": {...}},
+         "location": {"spine1_Ethernet1_32": {...}}}
+    The index is kept on the bootflash and reused on later hops while its MD5 in the
+    manifest doesn't change.
+    """
+    global config_index
+
+    if config_index != None:
+        return config_index
+
+    entry = get_manifest_entry(options["config_index"])
+    cache = read_poap_cache("config_index")
+    if entry != None and entry.get("md5") and cache.get("md5") == entry["md5"]:
+        poap_log("Using cached config index (MD5 %s)" % entry["md5"])
+        config_index = cache["index"]
+        return config_index
+
+    dst = "poap_config_index.json"
+    do_copy(options["config_index"], dst, options["timeout_config"], "%s.tmp" % dst)
+    index_file = os.path.join(options["destination_path"], dst)
+    try:
+        with open(index_file, "r") as index_hdl:
+            config_index = json.load(index_hdl)
+    except (IOError, OSError, ValueError) as e:
+        abort("Unable to load config index %s: %s" % (options["config_index"], str(e)))
+    remove_file(index_file)
+
+    if entry != None and entry.get("md5"):
+        write_poap_cache("config_index", {"md5": entry["md5"], "index": config_index})
+    return config_index
+
+
+def normalize_mac(mac):
+    """
+    Formats a MAC address the way the config index stores it (e.g. 7426CC5C9180)
+    """
+    return re.sub("[^0-9A-Fa-f]", "", mac).upper()
+
+
+def get_switch_identifiers(identifier_type):
+    """
+    Gets the identifiers of this switch for one identifier type of the config index
+    """
+    if identifier_type == "serial_number":
+        return [os.environ[name] for name in ["POAP_SERIAL"] if name in os.environ]
+    elif identifier_type == "mac":
+        return [normalize_mac(os.environ[name]) for name in ["POAP_MAC", "POAP_RMAC", "POAP_MGMT_MAC"]
+                if name in os.environ]
+    elif identifier_type == "hostname":
+        return [os.environ[name] for name in ["POAP_HOST_NAME"] if name in os.environ]
+    elif identifier_type == "location":
+        return get_neighbor_locations()
+    return []
+
+
+def set_cfg_file_from_index():
+    """
+    Sets the configuration file from the config lookup index. The identifiers of the
+    switch are tried in the order of "config_lookup_order" and the first one found in
+    the index wins. Returns False if none of them is in the index.
+    """
+    index = load_config_index()
+
+    for identifier_type in options["config_lookup_order"]:
+        entries = index.get(identifier_type, {})
+        if len(entries) == 0:
+            continue
+        for identifier in get_switch_identifiers(identifier_type):
+            entry = entries.get(identifier)
+            if entry == None:
+                continue
+            poap_log("Found %s %s in the config index" % (identifier_type, identifier))
+            options["config_path"] = os.path.join(options["config_path"], os.path.dirname(entry["path"]))
+            options["source_config_file"] = os.path.basename(entry["path"])
+            options["source_config_md5"] = entry.get("md5", "")
+            poap_log("Selected conf file name : %s" % options["source_config_file"])
+            return True
+
+    poap_log("None of the switch identifiers (%s) is in the config index" % ", ".join(options["config_lookup_order"]))
+    return False
+
+
 def setup_mode():
     """
     Sets the config file name based on the mode
     """
     supported_modes = ["location", "serial_number", "mac", "hostname", "personality", "raw"]
+    if options["config_index"] and options["mode"] != "personality" and os.environ.get("POAP_PHASE", None) != "USB":
+        if set_cfg_file_from_index():
+            options["serial_number"] = os.environ.get('POAP_SERIAL', "")
+            return
+        poap_log("Falling back to the configuration file name of mode %s" % options["mode"])
+
     if options["mode"] == "location":
         set_cfg_file_location()
         options["serial_number"] = os.environ['POAP_SERIAL']
@@ -2264,8 +4835,6 @@ def setup_logging():
     """
     global log_hdl
 
-    poap_cleanup_script_logs()
-
     usb_mode = "usb_" if os.environ.get("POAP_PHASE", None) == "USB" else ""
 
     poap_script_log = "/bootflash/%s_poap_%s_%sscript.log" % (strftime("%Y%m%d%H%M%S", gmtime()), os.environ['POAP_PID'], usb_mode)
@@ -2276,6 +4845,8 @@ def setup_logging():
     except exception as e:
         abort("Could not create log file! Error: %s " % str(e))
 
+    poap_rotate_script_logs(poap_script_log)
+
 
 def invoke_personality_restore():
     """
@@ -2368,8 +4939,7 @@ def get_bios_date():
     global bios_date
     
     try:
-        bios_date = cli("show version | i 'BIOS compile time: ' | sed 's/.*:  //'")
-        bios_date = bios_date.strip('\n')
+        bios_date = get_show_version_line("BIOS compile time: ").split(":  ", 1)[1]
         poap_log("System BIOS version date: " + bios_date)
     except Exception as e:
         poap_log("Unable to detect system BIOS version date!")
@@ -2406,61 +4976,152 @@ def get_IP_addresses():
         poap_log("Unable to detect interface IP information!")
         abort(str(e))
 
+def run_tasks(tasks):
+    """
+    Runs a list of (name, function, dependencies) tasks. A task starts as soon as all
+    the tasks it depends on are done, with up to "task_workers" tasks running at the
+    same time. With "serial_execution" the tasks run one after the other, in the order
+    of the list. If a task fails, no new task is started and the script aborts once the
+    running ones are done. The start and duration of each task are logged at the end.
+    """
+    names = [name for name, _, _ in tasks]
+    for name, _, dependencies in tasks:
+        for dependency in dependencies:
+            if dependency not in names[:names.index(name)]:
+                abort("Task %s depends on %s, which isn't listed before it" % (name, dependency))
+
+    timings = {}
+    failures = []
+    done = set()
+    running = set()
+    condition = threading.Condition()
+    start = time.time()
+
+    def run_task(name, function):
+        task_start = time.time()
+        try:
+            profile_task(function)
+        except (Exception, SystemExit) as e:
+            failures.append((name, e))
+        timings[name] = (task_start - start, time.time() - task_start)
+        with condition:
+            running.discard(name)
+            done.add(name)
+            condition.notify()
+
+    if options["serial_execution"] == True:
+        poap_log("Running %d task(s) serially" % len(tasks))
+        for name, function, _ in tasks:
+            # Failures abort from the main thread right away
+            task_start = time.time()
+            function()
+            timings[name] = (task_start - start, time.time() - task_start)
+    else:
+        pending = list(tasks)
+        with condition:
+            while len(pending) > 0 or len(running) > 0:
+                if len(failures) == 0:
+                    for task in list(pending):
+                        name, function, dependencies = task
+                        if len(running) >= options["task_workers"]:
+                            break
+                        if not set(dependencies).issubset(done):
+                            continue
+                        pending.remove(task)
+                        running.add(name)
+                        task_thread = threading.Thread(target=run_task, args=(name, function))
+                        task_thread.daemon = True
+                        task_thread.start()
+                elif len(running) == 0:
+                    break
+                condition.wait()
+
+    poap_log("Task timing report (%.1fs in total):" % (time.time() - start))
+    for name in names:
+        if name in timings:
+            poap_log("    %-20s started at %6.1fs, took %6.1fs" % (name, timings[name][0], timings[name][1]))
+        else:
+            poap_log("    %-20s not run" % name)
+
+    if len(failures) > 0:
+        name, e = failures[0]
+        abort("Task %s failed: %s" % (name, str(e) or type(e).__name__))
+
+
+def plan_upgrade():
+    """
+    Checks the upgrade path and sets the next image to install. Aborts if the switch is
+    already on the final image.
+    """
+    # If "only_allow_versions_in_upgrade_path" is set to True, check to see if the switch is currently on one
+    # of the NX-OS versions that is listed in the upgrade path. Otherwise, exit the script.
+    if options["only_allow_versions_in_upgrade_path"] == True:
+        verify_current_switch_os_is_in_upgrade_path()
+
+    is_this_the_final_upgrade = set_next_upgrade_from_upgrade_path()
+    # If the switch is already on the final NX-OS version. There is nothing to do.
+    if is_this_the_final_upgrade is None:
+        abort("The script will exit now")
+    options["copy_config"] = is_this_the_final_upgrade
+
+
+def fetch_final_config():
+    """
+    Fetches the configuration file if this is the final upgrade
+    """
+    if options["copy_config"] == True:
+        fetch_config()
+
+
+def is_already_on_final_image():
+    """
+    Checks, with the cached "show version", if the switch already runs the last image of
+    the upgrade path. Used to exit before anything else runs.
+    """
+    try:
+        return get_show_version_line("NXOS image file").split("/")[3] == options["upgrade_path"][-1]
+    except Exception as e:
+        poap_log("Unable to check the booted image: %s" % str(e))
+        return False
+
+
 def main():
 
     global options
 
     signal.signal(signal.SIGTERM, sigterm_handler)
     
+    start = time.time()
+
     # Set all the default parameters and validate the ones provided
     set_defaults_and_validate_options()
 
+    # Nothing to do (and nothing to roll back) if the switch already runs the final image.
+    # This still exits with an error like before, POAP just doesn't go through the rollback.
+    if is_already_on_final_image():
+        setup_logging()
+        poap_log("This switch is already on the final target image %s, nothing to do (%.3fs)" % (
+            options["upgrade_path"][-1], time.time() - start))
+        upload_log_bundle()
+        close_log_handle()
+        exit(1)
+
     # Configure the logging for the POAP process
     setup_logging()
 
-    # Initialize parameters based on the mode
-    setup_mode()
-    
-    # Get the model of the switch
-    get_switch_model()
-
-    # Get the NX-OS version of the switch
-    get_nxos_version()
-
-    # Get the build date of the NX-OS version
-    get_nxos_date()
-
-    # Get the BIOS version of the switch
-    get_bios_version()
+    # Time counts against the boot window, so keep an eye on how long the script takes to start
+    startup_time = time.time() - import_start
+    poap_log("Script modules imported in %.3fs, started in %.3fs" % (import_time, startup_time))
+    if startup_time > options["startup_time_budget"]:
+        poap_log("WARN: Script start took %.3fs, over the budget of %.3fs" % (startup_time, options["startup_time_budget"]))
 
-    # Get the BIOS build date of the switch
-    get_bios_date()
-
-    # Get the filename of the currently booted NX-OS version
-    get_currently_booted_image_filename()
-
-    # Get the current IP addresses on any interface of the switch
-    get_IP_addresses()
-
-    # Get the current DNS information of the switch
-    get_DNS()
-    
-    # If "only_allow_versions_in_upgrade_path" is set to True, check to see if the switch is currently on one
-    # of the NX-OS versions that is listed in the upgrade path. Otherwise, exit the script.
     if options["only_allow_versions_in_upgrade_path"] == True:
         poap_log("You have set Only Allow Versions In Upgrade Path to True")
         poap_log("Only switches that are listed in your upgrade path will be affected")
-        verify_current_switch_os_is_in_upgrade_path()
     if options["only_allow_versions_in_upgrade_path"] == False:
         poap_log("You have set Only Allow Versions In Upgrade Path to False")
         poap_log("Switches that are not listed in your upgrade path will be affected")
 
-    # Verify the free space on the bootflash satisfies the free space requirement set by the user
-    verify_storage_capacity()
-
-    # Create the directory structure needed for the POAP process
-    create_destination_directories()
-
     if options["require_md5"] == True:
         poap_log("You have set Require MD5 to True")
         poap_log("All files that are applied will have MD5 sums verified")
@@ -2468,27 +5129,54 @@ def main():
         poap_log("You have set Require MD5 to False")
         poap_log("All files that are applied will not have MD5 sums verified")
 
-    is_this_the_final_upgrade = set_next_upgrade_from_upgrade_path()
-    # If the switch is already on the final NX-OS version. There is nothing to do.
-    if is_this_the_final_upgrade is None:
-        abort("The script will exit now")
+    profile_checkpoint("startup")
+
+    # Everything up to the erase of the configuration runs as a graph of tasks.
+    # Discovery, the manifest and the mode setup don't depend on each other, and the
+    # configuration is fetched while the system image is copied.
+    run_tasks([
+        # Create the directory structure needed for the POAP process
+        ("directories", create_destination_directories, []),
+        ("manifest", load_manifest, []),
+        # Initialize parameters based on the mode
+        ("mode", setup_mode, ["directories"]),
+        ("switch_model", get_switch_model, []),
+        ("nxos_version", get_nxos_version, []),
+        ("nxos_date", get_nxos_date, []),
+        ("bios_version", get_bios_version, []),
+        ("bios_date", get_bios_date, []),
+        ("booted_image", get_currently_booted_image_filename, []),
+        ("ip_addresses", get_IP_addresses, []),
+        ("dns", get_DNS, []),
+        ("upgrade_path", plan_upgrade, ["booted_image"]),
+        # Verify the free space on the bootflash is enough for the files this run downloads
+        ("storage", verify_storage_capacity, ["manifest", "mode", "upgrade_path"]),
+        ("system_image", copy_system, ["storage"]),
+        ("config", fetch_final_config, ["storage"]),
+        # Check the install impact before anything is erased
+        ("install_impact", precheck_install, ["nxos_version", "system_image"]),
+    ])
+    profile_checkpoint("tasks")
+
     # If the switch is going to install the final upgrade, we need to copy the configuration.
-    elif is_this_the_final_upgrade == True:
+    if options["copy_config"] == True and not apply_config_diff():
         erase_configuration()
         poap_log("The configuration will now be copied because this is the final upgrade")
         copy_config()
-
-    copy_system()
+        profile_checkpoint("config")
 
     signal.signal(signal.SIGTERM, sig_handler_no_exit)
 
     install_nxos_issu()
+    profile_checkpoint("install")
 
-    log_hdl.close()
+    upload_log_bundle()
+    close_log_handle()
     exit(0)
 
 
 if __name__ == "__main__":
+    start_profiling()
     try:
         main()
     except Exception:
@@ -2499,4 +5187,7 @@ if __name__ == "__main__":
             poap_log("Stack - File: {0} Line: {1}".format(fname, exc_tb.tb_lineno))
             exc_tb = exc_tb.tb_next
         abort()
+    finally:
+        # Already done when the log was closed, unless the script exited before that
+        stop_profiling()
 
@@ -0,0 +1,314 @@
+#!/bin/env python3
+
+"""
+Companion tool for the POAP script, run on the file server (not on the switch).
+It generates the files the POAP script can use to find its data on the server.
+
+    fleet-index     Builds the fleet recipe index used by the "recipe_index" option
+    config-index    Builds the config lookup index used by the "config_index" option
+    manifest        Writes the .md5 files and the manifest used by the "manifest_file" option
+    config-grammar  Derives the grammar used by the "config_grammar" option from captured configs
+    validate-config Validates configuration files against that grammar, in bulk
+
+The file formats are defined in the POAP script itself, which this tool imports
+(see --poap-script).
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import importlib.util
+import json
+import mmap
+import multiprocessing
+import os
+import re
+import sys
+
+
+def load_poap_script(path):
+    """
+    Imports the POAP script so the file formats are shared with it
+    """
+    spec = importlib.util.spec_from_file_location("poap_script", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_file(path, data):
+    """
+    Writes a file atomically, so a switch never downloads a partial file
+    """
+    with open("%s.tmp" % path, "wb") as file_hdl:
+        file_hdl.write(data)
+    os.rename("%s.tmp" % path, path)
+
+
+def fleet_index(args):
+    """
+    Builds the fleet recipe index from <install_path>/<serial>/<serial>.yaml (or .yml)
+    """
+    poap = load_poap_script(args.poap_script)
+
+    entries = {}
+    for serial in sorted(os.listdir(args.install_path)):
+        for extension in [".yaml", ".yml"]:
+            recipe = os.path.join(args.install_path, serial, serial + extension)
+            if not os.path.isfile(recipe):
+                continue
+            with open(recipe, "rb") as recipe_hdl:
+                data = recipe_hdl.read()
+            entry = {"md5": hashlib.md5(data).hexdigest()}
+            if args.embed:
+                entry["recipe"] = data.decode("utf-8")
+            else:
+                entry["path"] = "%s/%s%s" % (serial, serial, extension)
+            entries[serial] = entry
+            break
+
+    output = args.output or os.path.join(args.install_path, "poap_recipes.idx")
+    write_file(output, poap.build_fleet_index(entries, args.buckets))
+    print("Wrote %s with %d recipe(s)" % (output, len(entries)))
+
+
+def config_index(args):
+    """
+    Builds the config lookup index from the file names the POAP modes use under
+    <config_path>: conf.<serial>, conf_<mac>.cfg, conf_<switch>_<intf>.cfg and
+    conf_<hostname>.cfg
+    """
+    index = {"version": 1, "serial_number": {}, "mac": {}, "hostname": {}, "location": {}}
+    for root, _, files in os.walk(args.config_path):
+        for name in sorted(files):
+            if name.endswith(".md5"):
+                continue
+            match = re.match(r"conf\.(.+)$", name)
+            if match:
+                identifier_type, identifier = "serial_number", match.group(1)
+            else:
+                match = re.match(r"conf_(.+)\.cfg$", name)
+                if not match:
+                    continue
+                identifier = match.group(1)
+                if re.match(r"[0-9A-Fa-f]{12}$", identifier):
+                    identifier_type, identifier = "mac", identifier.upper()
+                elif re.match(r".+_(Eth|Ethernet|mgmt)\d", identifier):
+                    identifier_type = "location"
+                else:
+                    identifier_type = "hostname"
+
+            path = os.path.join(root, name)
+            md5 = hashlib.md5()
+            with open(path, "rb") as config_hdl:
+                for chunk in iter(lambda: config_hdl.read(1024 * 1024), b""):
+                    md5.update(chunk)
+            index[identifier_type][identifier] = {"path": os.path.relpath(path, args.config_path),
+                                                  "md5": md5.hexdigest()}
+
+    output = args.output or os.path.join(args.config_path, "poap_config_index.json")
+    write_file(output, json.dumps(index, indent=1, sort_keys=True).encode("utf-8"))
+    print("Wrote %s with %d config file(s)" % (output, sum(len(index[key]) for key in index if key != "version")))
+
+
+def hash_file(path):
+    """
+    Computes the MD5 of a file through mmap (run in the worker processes of manifest())
+    """
+    md5 = hashlib.md5()
+    with open(path, "rb") as file_hdl:
+        if os.fstat(file_hdl.fileno()).st_size > 0:
+            with mmap.mmap(file_hdl.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for offset in range(0, len(data), 16 * 1024 * 1024):
+                    md5.update(data[offset:offset + 16 * 1024 * 1024])
+    return md5.hexdigest()
+
+
+def manifest(args):
+    """
+    Walks the server paths the switches download from and writes a <file>.md5 next to
+    every file (the format of md5sum, read by get_md5() in the POAP script) and the
+    consolidated manifest. Files are hashed in a process pool, and files whose size and
+    modification time haven't changed since the last run are taken from a cache.
+    """
+    poap = load_poap_script(args.poap_script)
+
+    server_paths = args.path or [poap.options[option] for option in ["config_path", "upgrade_image_path", "install_path"]
+                                 if poap.options.get(option)]
+    output = args.output or os.path.join(args.root, "poap_manifest.json")
+    cache_file = os.path.join(args.root, ".poap_manifest_cache.json")
+    try:
+        with open(cache_file, "r") as cache_hdl:
+            cache = json.load(cache_hdl)
+    except (IOError, OSError, ValueError):
+        cache = {}
+
+    files = {}
+    for server_path in server_paths:
+        local_path = os.path.join(args.root, server_path.lstrip("/"))
+        for root, _, names in os.walk(local_path):
+            for name in names:
+                path = os.path.join(root, name)
+                if name.endswith((".md5", ".tmp")) or path in [output, cache_file, "%s.tmp" % output]:
+                    continue
+                files[os.path.normpath("/" + os.path.relpath(path, args.root))] = path
+
+    to_hash = []
+    stats = {}
+    for path in files.values():
+        stats[path] = os.stat(path)
+        entry = cache.get(path)
+        if entry == None or entry["size"] != stats[path].st_size or entry["mtime"] != stats[path].st_mtime:
+            to_hash.append(path)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for path, md5 in zip(to_hash, pool.map(hash_file, to_hash)):
+            cache[path] = {"size": stats[path].st_size, "mtime": stats[path].st_mtime, "md5": md5}
+
+    sidecars = 0
+    entries = {}
+    for server_path, path in sorted(files.items()):
+        entries[server_path] = {"size": cache[path]["size"], "md5": cache[path]["md5"]}
+        if args.no_sidecars:
+            continue
+        sidecar = "%s  %s\n" % (cache[path]["md5"], os.path.basename(path))
+        try:
+            with open("%s.md5" % path, "r") as sidecar_hdl:
+                if sidecar_hdl.read() == sidecar:
+                    continue
+        except (IOError, OSError):
+            pass
+        write_file("%s.md5" % path, sidecar.encode("utf-8"))
+        sidecars += 1
+
+    write_file(output, json.dumps({"version": 1, "files": entries}, indent=1, sort_keys=True).encode("utf-8"))
+    cache = dict((path, cache[path]) for path in files.values())
+    write_file(cache_file, json.dumps(cache).encode("utf-8"))
+    print("Wrote %s with %d file(s): %d hashed, %d unchanged, %d .md5 file(s) updated" % (
+        output, len(entries), len(to_hash), len(entries) - len(to_hash), sidecars))
+
+
+def config_grammar(args):
+    """
+    Derives the grammar of the configuration validator from captured configurations or
+    command lists (indented like a running configuration)
+    """
+    poap = load_poap_script(args.poap_script)
+
+    grammar = {}
+    for captured in args.captured:
+        with open(captured, "r") as captured_hdl:
+            poap.build_config_grammar(captured_hdl, grammar)
+
+    write_file(args.output, json.dumps(grammar, indent=1, sort_keys=True).encode("utf-8"))
+    print("Wrote %s with %d top-level command(s)" % (args.output, len(grammar)))
+
+
+# State of the validate-config worker processes, see init_validator()
+validator = {}
+
+
+def init_validator(poap_script, grammar):
+    """
+    Loads the POAP script and the grammar in a validate-config worker process
+    """
+    validator["poap"] = load_poap_script(poap_script)
+    validator["grammar"] = grammar
+
+
+def validate_one_config(path):
+    """
+    Validates one configuration file (run in the validate-config worker processes)
+    """
+    try:
+        return path, validator["poap"].validate_config_file(path, validator["grammar"])
+    except (IOError, OSError, UnicodeDecodeError) as e:
+        return path, [(0, "Unable to read the file: %s" % str(e))]
+
+
+def validate_config(args):
+    """
+    Validates configuration files (or all the files in directories) against a grammar
+    written by config-grammar, in a pool of worker processes
+    """
+    with open(args.grammar, "r") as grammar_hdl:
+        grammar = json.load(grammar_hdl)
+
+    paths = []
+    for path in args.configs:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                paths.extend(os.path.join(root, name) for name in sorted(names)
+                             if not name.endswith((".md5", ".json", ".idx", ".tmp")))
+        else:
+            paths.append(path)
+
+    failed = 0
+    pool = multiprocessing.Pool(args.workers, initializer=init_validator, initargs=(args.poap_script, grammar))
+    try:
+        for path, errors in pool.imap_unordered(validate_one_config, paths, chunksize=16):
+            if len(errors) == 0:
+                continue
+            failed += 1
+            for line_number, error in errors:
+                print("%s:%d: %s" % (path, line_number, error))
+    finally:
+        pool.close()
+        pool.join()
+
+    print("Validated %d configuration file(s), %d with errors" % (len(paths), failed))
+    return 1 if failed > 0 else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Companion tool for the POAP script")
+    parser.add_argument("--poap-script", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                             "poap_http_multi_upgrade.py"),
+                        help="path of the POAP script (default: next to this tool)")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    parser_fleet_index = subparsers.add_parser("fleet-index", help="build the fleet recipe index")
+    parser_fleet_index.add_argument("install_path", help="directory with one <serial>/<serial>.yaml per switch")
+    parser_fleet_index.add_argument("-o", "--output", help="index file (default: <install_path>/poap_recipes.idx)")
+    parser_fleet_index.add_argument("--buckets", type=int, help="number of buckets (default: one per 8 recipes, at most 340)")
+    parser_fleet_index.add_argument("--embed", action="store_true",
+                                    help="embed the recipes in the index instead of pointing to them")
+    parser_fleet_index.set_defaults(func=fleet_index)
+
+    parser_config_index = subparsers.add_parser("config-index", help="build the config lookup index")
+    parser_config_index.add_argument("config_path", help="directory with the configuration files")
+    parser_config_index.add_argument("-o", "--output",
+                                     help="index file (default: <config_path>/poap_config_index.json)")
+    parser_config_index.set_defaults(func=config_index)
+
+    parser_manifest = subparsers.add_parser("manifest", help="write the .md5 files and the manifest")
+    parser_manifest.add_argument("root", help="directory the file server serves as /")
+    parser_manifest.add_argument("--path", action="append",
+                                 help="server path to include, can be repeated (default: config_path, "
+                                      "upgrade_image_path and install_path of the POAP script)")
+    parser_manifest.add_argument("-o", "--output", help="manifest file (default: <root>/poap_manifest.json)")
+    parser_manifest.add_argument("--workers", type=int, help="number of hashing processes (default: one per CPU)")
+    parser_manifest.add_argument("--no-sidecars", action="store_true", help="don't write the .md5 files")
+    parser_manifest.set_defaults(func=manifest)
+
+    parser_config_grammar = subparsers.add_parser("config-grammar",
+                                                  help="derive the config validator grammar from captured configs")
+    parser_config_grammar.add_argument("captured", nargs="+",
+                                       help="captured configurations or command lists, indented by mode")
+    parser_config_grammar.add_argument("-o", "--output", default="poap_config_grammar.json",
+                                       help="grammar file (default: poap_config_grammar.json)")
+    parser_config_grammar.set_defaults(func=config_grammar)
+
+    parser_validate_config = subparsers.add_parser("validate-config", help="validate configuration files")
+    parser_validate_config.add_argument("grammar", help="grammar file written by config-grammar")
+    parser_validate_config.add_argument("configs", nargs="+", help="configuration files or directories")
+    parser_validate_config.add_argument("--workers", type=int, help="number of processes (default: one per CPU)")
+    parser_validate_config.set_defaults(func=validate_config)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
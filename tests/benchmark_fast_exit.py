@@ -0,0 +1,81 @@
+"""
+Benchmarks the no-op run: main() on a switch that already runs the last image of the
+upgrade path, against the stub CLI in tests/stub (so the switch's own "show version"
+time isn't counted). Checks that main() logs it and exits with status 1, and prints
+the time main() takes until it exits and the time of the whole run from a new
+interpreter.
+
+Run with: python tests/benchmark_fast_exit.py [runs]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+
+# A no-op run, timing main() itself. The log goes to a temporary file instead of the
+# bootflash, which only exists on the switch.
+NO_OP_RUN = """
+import sys
+import time
+import poap_http_multi_upgrade as poap
+
+log_file = sys.argv[1]
+
+
+def setup_logging():
+    poap.log_hdl = open(log_file, "w+")
+
+
+poap.setup_logging = setup_logging
+poap.options["mode"] = "serial_number"
+start = time.time()
+try:
+    poap.main()
+except SystemExit as e:
+    assert e.code == 1, "main() exited with %s" % e.code
+elapsed = time.time() - start
+with open(log_file, "r") as log_hdl:
+    assert "already on the final target image" in log_hdl.read()
+print("%.6f" % elapsed)
+"""
+
+
+def run_no_op():
+    """
+    Runs one no-op run in a new interpreter. Returns the time main() took and the time
+    of the whole run.
+    """
+    import poap_http_multi_upgrade as poap
+
+    env = dict(os.environ)
+    env.update({"PYTHONPATH": os.pathsep.join([os.path.join(TESTS_DIR, "stub"), REPO_DIR]),
+                "POAP_SERIAL": "SAL1911B05K", "POAP_PID": "1", "POAP_VRF": "management",
+                "POAP_STUB_IMAGE": poap.options["upgrade_path"][-1]})
+    log_hdl, log_file = tempfile.mkstemp(prefix="poap_fast_exit_", suffix=".log")
+    os.close(log_hdl)
+    try:
+        start = time.time()
+        output = subprocess.check_output([sys.executable, "-c", NO_OP_RUN, log_file], env=env)
+        elapsed = time.time() - start
+    finally:
+        os.remove(log_file)
+    return float(output.decode().strip().split("\n")[-1]), elapsed
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    sys.path.insert(0, REPO_DIR)
+    results = [run_no_op() for _ in range(runs)]
+    main_times = sorted(main_time for main_time, _ in results)
+    run_times = sorted(run_time for _, run_time in results)
+    print("No-op run over %d runs (median / max):" % runs)
+    print("    main()          %.4fs / %.4fs" % (main_times[runs // 2], main_times[-1]))
+    print("    whole process   %.4fs / %.4fs" % (run_times[runs // 2], run_times[-1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+"""
+Stand-in for the NX-OS "cli" module, so poap_http_multi_upgrade.py can be imported and
+run off the switch by the tests and benchmarks. Every command returns right away.
+"show version" reports the image in POAP_STUB_IMAGE (nxos.9.3.9.bin by default),
+"show running-config" the file in POAP_STUB_RUNNING_CONFIG, anything else no output.
+"""
+import os
+
+SHOW_VERSION = """Cisco Nexus Operating System (NX-OS) Software
+Software
+  BIOS: version 05.45
+  NXOS: version 9.3(9)
+  BIOS compile time:  07/05/2021
+  NXOS image file is: bootflash:///%s
+  NXOS compile time:  12/22/2021 2:00:00 [12/22/2021 18:58:23]
+
+Hardware
+  cisco Nexus9000 C93180YC-EX chassis
+"""
+
+
+def cli(command):
+    if command == "show version":
+        return SHOW_VERSION % os.environ.get("POAP_STUB_IMAGE", "nxos.9.3.9.bin")
+    if command == "show running-config" and "POAP_STUB_RUNNING_CONFIG" in os.environ:
+        with open(os.environ["POAP_STUB_RUNNING_CONFIG"], "r") as config_hdl:
+            return config_hdl.read()
+    return ""
+
+
+def clid(command):
+    return "{}"
@@ -0,0 +1,89 @@
+"""
+Plans of the "diff" config apply mode against a real "show running-config" capture
+(tests/data/show_running_config.txt) and the configuration file of the same switch
+(tests/data/conf.leaf1). The defaults in the running configuration that the file
+doesn't list (copp, SNMP user, vlan 1, line console/vty, empty interfaces...) must be
+kept. Removing any other top-level line, or a section inside a section of the file,
+and changed lines with ";" or in a banner must fall back to replace.
+
+Run with pytest, or on its own: python tests/test_config_diff.py
+"""
+import os
+import sys
+import tempfile
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(TESTS_DIR, "data")
+sys.path[0:0] = [os.path.join(TESTS_DIR, "stub"), os.path.dirname(TESTS_DIR)]
+os.environ.update({"POAP_SERIAL": "SAL1911B05K", "POAP_PID": "1", "POAP_VRF": "management",
+                   "POAP_STUB_RUNNING_CONFIG": os.path.join(DATA_DIR, "show_running_config.txt")})
+
+import poap_http_multi_upgrade as poap
+
+poap.set_defaults_and_validate_options()
+
+
+def plan(config_lines):
+    """
+    Plans the diff of the running configuration capture against a configuration file
+    """
+    config_hdl, config_file = tempfile.mkstemp(prefix="poap_diff_")
+    try:
+        with os.fdopen(config_hdl, "w") as config_out:
+            config_out.write("\n".join(config_lines) + "\n")
+        return poap.plan_config_diff(config_file)
+    finally:
+        os.remove(config_file)
+
+
+def read_config():
+    with open(os.path.join(DATA_DIR, "conf.leaf1"), "r") as config_hdl:
+        return config_hdl.read().split("\n")
+
+
+def test_running_config_defaults_are_kept():
+    changes = plan(read_config())
+    assert changes == [
+        (("interface Ethernet1/1",), "no description uplink to spine1", "remove", False),
+        (("interface Ethernet1/1",), "description uplink to spine2", "add", False),
+        ((), "interface loopback1", "add", True),
+        (("interface loopback1",), "ip address 10.255.1.1/32", "add", False),
+    ]
+    for _, command, _, _ in changes:
+        for default in ["copp", "snmp-server", "rmon", "vlan 1", "line ", "Ethernet1/2", "Vlan1", "vdc", "boot"]:
+            assert default not in command
+
+
+def test_removed_top_level_line_falls_back_to_replace():
+    for removed in [["feature bgp"], ["ntp server 10.0.0.5 use-vrf management"], ["vlan 10", "  name servers"]]:
+        config = [line for line in read_config() if line not in removed]
+        assert plan(config) == None, "Removing %s was planned live" % removed[0]
+
+
+def test_removed_section_falls_back_to_replace():
+    config = read_config()
+    neighbor = config.index("  neighbor 10.1.1.0")
+    assert plan(config[:neighbor]) == None
+
+
+def test_removed_empty_section_falls_back_to_replace():
+    # "address-family ipv4 unicast" of the neighbor has no lines under it
+    config = [line for line in read_config() if line != "    address-family ipv4 unicast"]
+    assert plan(config) == None
+
+
+def test_semicolon_and_banner_fall_back_to_replace():
+    config = [line.replace("uplink to spine2", "uplink; to spine2") for line in read_config()]
+    assert plan(config) == None
+    config = read_config() + ["banner motd #", "hello world", "welcome", "#"]
+    assert plan(config) == None
+    config = read_config() + ["banner motd #welcome#"]
+    assert plan(config) == None
+
+
+if __name__ == "__main__":
+    test_running_config_defaults_are_kept()
+    test_removed_top_level_line_falls_back_to_replace()
+    test_removed_section_falls_back_to_replace()
+    test_removed_empty_section_falls_back_to_replace()
+    test_semicolon_and_banner_fall_back_to_replace()
@@ -0,0 +1,105 @@
+"""
+Memory ceiling of the configuration file handling. A 200 MB synthetic configuration
+goes through split_config_file(), install_license() and a check_if_rpm_in_file() scan
+in a new interpreter, and the peak RSS of that interpreter may not grow by more than
+MEMORY_CEILING over what it used before. Reading a whole file into memory again would
+grow it by at least the size of the file.
+
+Run with pytest, or on its own: python tests/test_config_memory.py
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+
+CONFIG_SIZE = 200 * 1024 * 1024
+MEMORY_CEILING = 32 * 1024 * 1024
+
+PROCESS_CONFIG = """
+import json
+import os
+import resource
+import sys
+import poap_http_multi_upgrade as poap
+
+work_dir = sys.argv[1]
+
+
+def peak_rss():
+    # In KB on Linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+poap.set_defaults_and_validate_options()
+poap.options.update({"destination_path": work_dir, "destination_config": "poap.cfg",
+                     "split_config_first": os.path.join(work_dir, "poap.cfg.1"),
+                     "split_config_second": os.path.join(work_dir, "poap.cfg.2"),
+                     "destination_system_image": "nxos.9.3.10.bin", "target_system_image": "nxos.9.3.10.bin"})
+# split_config_file() writes to these globals, the script doesn't open them itself
+poap.config_file_first = open(poap.options["split_config_first"], "w")
+poap.config_file_second = open(poap.options["split_config_second"], "w")
+poap.empty_first_file = 1
+baseline = peak_rss()
+
+poap.split_config_file()
+poap.config_file_first.close()
+poap.config_file_second.close()
+poap.install_license()
+found = poap.check_if_rpm_in_file(poap.options["split_config_second"], "no-such-rpm")
+
+print(json.dumps({"baseline": baseline, "peak": peak_rss(), "found": found,
+                  "size": os.path.getsize(poap.options["split_config_second"])}))
+"""
+
+
+def write_synthetic_config(filename, size):
+    """
+    Writes a configuration of interfaces of about the given size, a block at a time
+    """
+    written = 0
+    block = []
+    interface = 0
+    with open(filename, "w") as config_hdl:
+        while written < size:
+            interface += 1
+            block.append("interface Ethernet%d/%d\n  description uplink %d\n  no shutdown\n" % (
+                interface // 64 + 1, interface % 64 + 1, interface))
+            if len(block) == 10000:
+                data = "".join(block)
+                config_hdl.write(data)
+                written += len(data)
+                block = []
+
+
+def test_config_memory_ceiling():
+    work_dir = tempfile.mkdtemp(prefix="poap_memory_")
+    try:
+        write_synthetic_config(os.path.join(work_dir, "poap.cfg"), CONFIG_SIZE)
+        os.mkdir(os.path.join(work_dir, "poap_files"))
+        open(os.path.join(work_dir, "poap_files", "switch.lic"), "w").close()
+
+        env = dict(os.environ)
+        env.update({"PYTHONPATH": os.pathsep.join([os.path.join(TESTS_DIR, "stub"), REPO_DIR]),
+                    "POAP_SERIAL": "SAL1911B05K", "POAP_PID": "1", "POAP_VRF": "management"})
+        output = subprocess.check_output([sys.executable, "-c", PROCESS_CONFIG, work_dir], env=env)
+        result = json.loads(output.decode().strip().split("\n")[-1])
+
+        growth = result["peak"] - result["baseline"]
+        print("Processed %d MB, peak RSS %.1f MB (+%.1f MB)" % (
+            result["size"] // (1024 * 1024), result["peak"] / 1048576.0, growth / 1048576.0))
+        assert result["size"] >= CONFIG_SIZE
+        assert not result["found"]
+        assert growth < MEMORY_CEILING, "Peak RSS grew by %.1f MB, over the ceiling of %d MB" % (
+            growth / 1048576.0, MEMORY_CEILING // (1024 * 1024))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    test_config_memory_ceiling()
@@ -0,0 +1,52 @@
+"""
+Fails if the cold start of a plain serial-number run goes over the startup time budget
+("startup_time_budget"). The run is timed from the start of a new interpreter until
+main() would begin its work: the module is imported, the options are set and the booted
+image is checked, against the stub CLI in tests/stub.
+
+Run with pytest, or on its own: python tests/test_startup_time.py
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+
+# What main() does before its work, for a serial-number run that has to upgrade
+STARTUP = """
+import json
+import poap_http_multi_upgrade as poap
+poap.options["mode"] = "serial_number"
+poap.set_defaults_and_validate_options()
+assert not poap.is_already_on_final_image()
+print(json.dumps({"budget": poap.options["startup_time_budget"], "import_time": poap.import_time}))
+"""
+
+
+def time_cold_start():
+    """
+    Runs the start of the script in a new interpreter. Returns the wall time it took,
+    the budget and the import time the script measured itself.
+    """
+    env = dict(os.environ)
+    env.update({"PYTHONPATH": os.pathsep.join([os.path.join(TESTS_DIR, "stub"), REPO_DIR]),
+                "POAP_SERIAL": "SAL1911B05K", "POAP_PID": "1", "POAP_VRF": "management",
+                "POAP_STUB_IMAGE": "nxos.9.3.9.bin"})
+    start = time.time()
+    output = subprocess.check_output([sys.executable, "-c", STARTUP], env=env)
+    elapsed = time.time() - start
+    result = json.loads(output.decode().strip().split("\n")[-1])
+    return elapsed, result["budget"], result["import_time"]
+
+
+def test_cold_start_within_budget():
+    elapsed, budget, import_time = time_cold_start()
+    print("Cold start %.3fs (module import %.3fs), budget %.3fs" % (elapsed, import_time, budget))
+    assert elapsed < budget, "Cold start took %.3fs, over the budget of %.3fs" % (elapsed, budget)
+
+
+if __name__ == "__main__":
+    test_cold_start_within_budget()